@@ -1,20 +1,25 @@
 import asyncio
+import json
+from datetime import datetime
+from io import BytesIO
+from itertools import islice
 import logging
 import os
 from pathlib import Path
 import sys
 
-from aiogram import Bot, Dispatcher, F, Router, html
-from aiogram.utils.callback_answer import CallbackAnswerMiddleware
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from aiogram import Bot, F, Router, html
+from aiogram.utils.callback_answer import CallbackAnswer
 from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart, ExceptionTypeFilter
 from aiogram.filters.callback_data import CallbackData
 from aiogram.types.callback_query import CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
+    BufferedInputFile,
+    ErrorEvent,
     KeyboardButton,
     Message,
     ReplyKeyboardMarkup,
@@ -23,16 +28,26 @@ from aiogram.types import (
     InlineKeyboardButton,
 )
 import github
-import whisper
+from github.GitRef import GitRef
 
-from bot.middlewares import DbSessionMiddleware
 from bot.services.user_dal import UserDAL
+from bot.services.note_index_dal import NoteIndexDAL
 from bot.services.note_appender import NoteUser
+from bot.services.tracing import tracer
+from bot.services.image_pipeline import ImagePipeline, ImageSettings
+from bot.services.profiler import ProfilerBusyError, SamplingProfiler
+from bot.services.metrics import metrics
+from bot.services.sharding import ShardSupervisor
+from bot.services.transcriber import Transcriber
+from bot.services.media_stream import ByteBudget, MediaStream
+from bot.services.chat_import import ChatImporter
+from bot.services.import_dal import ImportDAL
+from bot.services.repository_lock import RepositoryLockTimeout
 from bot.config import config
+from bot.runtime import bot_runtime, run_shard_worker
 from bot.services.utils import batch
 
-model_size = "base"
-whisper_model = whisper.load_model(model_size)
+profiler = SamplingProfiler()
 form_router = Router()
 
 
@@ -94,6 +109,42 @@ async def cancel_handler(message: Message, state: FSMContext) -> None:
     )
 
 
+@form_router.message(Command("profile"), F.from_user.id.in_(config.bot.admin_ids))
+async def profile_handler(message: Message, command: CommandObject) -> None:
+    """
+    Sample stacks of the running bot, usage example: /profile 30
+    """
+    max_duration = 300
+    try:
+        duration = int(command.args) if command.args else 30
+    except ValueError:
+        await message.answer("Usage example: /profile 30")
+        return
+    duration = max(1, min(duration, max_duration))
+
+    await message.answer(f"Profiling for {duration} seconds...")
+    try:
+        collapsed_stacks = await profiler.profile(duration)
+    except ProfilerBusyError:
+        await message.answer("Profiler is already running, try again later.")
+        return
+
+    started_at = datetime.now().strftime("%Y%m%d_%H%M%S")
+    await message.answer_document(
+        BufferedInputFile(
+            collapsed_stacks.encode("utf-8"),
+            filename=f"profile_{started_at}.collapsed",
+        ),
+        caption="Collapsed stacks, open with speedscope or flamegraph.pl",
+    )
+
+
+@form_router.message(Command("profile"))
+async def profile_forbidden(message: Message) -> None:
+    # keeps the command of other users out of their notes
+    await message.answer("Profiling is available to admins only.")
+
+
 @form_router.message(RegisterForm.register_start)
 async def process_register_start(message: Message, state: FSMContext) -> None:
     await state.set_state(RegisterForm.github_token)
@@ -149,49 +200,297 @@ async def process_github_token(message: Message, state: FSMContext) -> None:
         )
         return
 
-    repos_names = [repo.name for repo in github_user.get_repos()]
-    repos_names_keyboard = [KeyboardButton(text=name) for name in repos_names]
-
-    keyboard = batch(repos_names_keyboard, 3)
-
     await message.bot.delete_message(message.chat.id, message.message_id)
     await state.update_data(github_username=github_username)
     await state.update_data(github_token=github_token)
     await state.set_state(RegisterForm.notes_repository)
 
+    picker = RepositoryPicker(token=github_token)
+    answer_data = await picker.get_selection_keyboard(state)
+
     await message.answer("Your token has been deleted for security reasons")
     await message.answer(
-        f"Your github username is {html.quote(github_username)}.\nWhat is your notes repository?",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=keyboard,
-            resize_keyboard=True,
-        ),
+        f"Your github username is {html.quote(github_username)}.\n"
+        "What is your notes repository?\n"
+        "You can also type the beginning of its name to search.",
+        reply_markup=ReplyKeyboardRemove(),
     )
+    await message.answer(
+        answer_data["text"],
+        reply_markup=answer_data["keyboard"],
+    )
+
+
+class GithubListPicker(object):
+    PAGE_SIZE = 24
+    # callback data is limited to 64 bytes, the prefix, page and index
+    # need the rest
+    QUERY_MAX_BYTES = 32
 
+    def __init__(self, token) -> None:
+        self.github = github.Github(token, per_page=self.PAGE_SIZE)
 
-@form_router.message(RegisterForm.notes_repository)
-async def process_notes_repository(message: Message, state: FSMContext) -> None:
+    def __init_subclass__(cls, **kwargs) -> None:
+        if "prefix" not in kwargs:
+            raise ValueError(
+                f"We also recommend to use short prefix name\n"
+                f"prefix required, usage example: "
+                f"`class {cls.__name__}(GithubListPicker, prefix='my_picker'): ...`"
+            )
+        prefix = kwargs.pop("prefix")
+        cls.__prefix__ = prefix
+        GithubListPicker._init_callbacks(cls, prefix)
+        super().__init_subclass__(**kwargs)
+
+    @classmethod
+    def _init_callbacks(cls, sub_cls, prefix):
+        # names may be longer than callback data allows, buttons carry the
+        # position of the name on the shown page instead
+        class SelectCallback(CallbackData, prefix=f"{prefix}_s"):
+            page: int
+            query: str
+            index: int
+
+        class PageCallback(CallbackData, prefix=f"{prefix}_p"):
+            page: int
+            query: str
+
+        sub_cls.SelectCallback = SelectCallback
+        sub_cls.PageCallback = PageCallback
+
+    @classmethod
+    def clean_query(cls, query):
+        """make query safe to be packed into callback data"""
+        query = (query or "").replace(":", "").strip()
+        # a character cut in half is dropped
+        return query.encode()[: cls.QUERY_MAX_BYTES].decode("utf-8", "ignore")
+
+    def get_items(self, query):
+        """lazy paginated list of items, only requested pages are fetched"""
+        raise NotImplementedError
+
+    def get_item_name(self, item):
+        return item.name
+
+    async def get_page(self, page, query):
+        if not query:
+            names = [
+                self.get_item_name(item)
+                for item in self.get_items(query).get_page(page)
+            ]
+            # github does not report the total count for free, a full page
+            # is the only hint that the next one exists
+            return names, len(names) == self.PAGE_SIZE
+
+        # search matches anywhere in the name, pages are cut from the names
+        # starting with the query so none of them is empty
+        prefix = query.casefold()
+        matching = (
+            name
+            for name in map(self.get_item_name, self.get_items(query))
+            if name.casefold().startswith(prefix)
+        )
+        # one name past the page tells whether the next one exists
+        start = page * self.PAGE_SIZE
+        names = list(islice(matching, start, start + self.PAGE_SIZE + 1))
+        return names[: self.PAGE_SIZE], len(names) > self.PAGE_SIZE
+
+    @classmethod
+    async def get_selected_name(cls, state: FSMContext, callback_data):
+        """name behind a select button, None when the list was replaced"""
+        shown = (await state.get_data()).get(f"{cls.__prefix__}_shown")
+        if not shown:
+            return None
+        if shown["page"] != callback_data.page or shown["query"] != callback_data.query:
+            return None
+        if not 0 <= callback_data.index < len(shown["names"]):
+            return None
+        return shown["names"][callback_data.index]
+
+    async def get_selection_keyboard(self, state: FSMContext, page=0, query=""):
+        query = self.clean_query(query)
+        names, has_next = await self.get_page(page, query)
+        await state.update_data(
+            {
+                f"{self.__prefix__}_shown": {
+                    "page": page,
+                    "query": query,
+                    "names": names,
+                }
+            }
+        )
+        result = {}
+
+        names_keyboards = [
+            InlineKeyboardButton(
+                text=name,
+                callback_data=self.SelectCallback(
+                    page=page, query=query, index=index
+                ).pack(),
+            )
+            for index, name in enumerate(names)
+        ]
+
+        navigation_keyboard = []
+        if page > 0:
+            navigation_keyboard.append(
+                InlineKeyboardButton(
+                    text="<- Prev",
+                    callback_data=self.PageCallback(page=page - 1, query=query).pack(),
+                )
+            )
+        if has_next:
+            navigation_keyboard.append(
+                InlineKeyboardButton(
+                    text="Next ->",
+                    callback_data=self.PageCallback(page=page + 1, query=query).pack(),
+                )
+            )
+
+        keyboard = [*batch(names_keyboards, 2)]
+        if navigation_keyboard:
+            keyboard.append(navigation_keyboard)
+
+        text = f"Page: {page + 1}"
+        if query:
+            text += f"\nSearch: {html.quote(query)}"
+        if not names:
+            text += "\nNothing found on this page."
+
+        result["text"] = text
+        result["keyboard"] = InlineKeyboardMarkup(inline_keyboard=keyboard)
+        return result
+
+
+class RepositoryPicker(GithubListPicker, prefix="rp"):
+    def get_items(self, query):
+        user = self.github.get_user()
+        if not query:
+            return user.get_repos(affiliation="owner", sort="pushed", direction="desc")
+
+        return self.github.search_repositories(
+            f"{query} in:name user:{user.login} fork:true",
+            sort="updated",
+            order="desc",
+        )
+
+
+class BranchPicker(GithubListPicker, prefix="bp"):
+    def __init__(self, token, username, repository) -> None:
+        super().__init__(token)
+        self.repository = repository
+        self.username = username
+
+    @property
+    def remote_repository(self):
+        return self.github.get_repo(f"{self.username}/{self.repository}", lazy=True)
+
+    def get_items(self, query):
+        if not query:
+            return self.remote_repository.get_branches()
+
+        return self.remote_repository.get_git_matching_refs(f"heads/{query}")
+
+    def get_item_name(self, item):
+        if isinstance(item, GitRef):
+            return item.ref.removeprefix("refs/heads/")
+        return item.name
+
+
+@form_router.message(RegisterForm.notes_repository, F.text)
+async def search_notes_repository(message: Message, state: FSMContext) -> None:
     register_data = await state.get_data()
-    github_token = register_data.get("github_token")
-    g = github.Github(github_token)
+    picker = RepositoryPicker(token=register_data.get("github_token"))
+    answer_data = await picker.get_selection_keyboard(state, query=message.text)
 
-    repository = message.text
-    github_username = g.get_user().login
-    repository_fullname = f"{github_username}/{repository}"
+    await message.answer(
+        answer_data["text"],
+        reply_markup=answer_data["keyboard"],
+    )
 
-    repo = g.get_repo(repository_fullname)
-    all_branches = [branch.name for branch in repo.get_branches()]
-    branches_keyboard = [KeyboardButton(text=branch) for branch in all_branches]
-    keyboard = batch(branches_keyboard, 3)
+
+@form_router.callback_query(RepositoryPicker.PageCallback.filter())
+async def navigate_notes_repository(
+    query: CallbackQuery,
+    callback_data: RepositoryPicker.PageCallback,
+    state: FSMContext,
+) -> None:
+    register_data = await state.get_data()
+    picker = RepositoryPicker(token=register_data.get("github_token"))
+    answer_data = await picker.get_selection_keyboard(
+        state, callback_data.page, callback_data.query
+    )
+
+    await query.message.edit_text(
+        answer_data["text"], reply_markup=answer_data["keyboard"]
+    )
+
+
+@form_router.callback_query(RepositoryPicker.SelectCallback.filter())
+async def process_notes_repository(
+    query: CallbackQuery,
+    callback_data: RepositoryPicker.SelectCallback,
+    state: FSMContext,
+    callback_answer: CallbackAnswer,
+) -> None:
+    repository = await RepositoryPicker.get_selected_name(state, callback_data)
+    if repository is None:
+        callback_answer.text = "This list is outdated, please search again."
+        return
+
+    register_data = await state.get_data()
+    picker = BranchPicker(
+        token=register_data.get("github_token"),
+        username=register_data.get("github_username"),
+        repository=repository,
+    )
+    answer_data = await picker.get_selection_keyboard(state)
 
     await state.update_data(notes_repository=repository)
     await state.set_state(RegisterForm.notes_branch)
+    await query.message.edit_text(
+        f"Repository: {html.quote(repository)}\n"
+        "What is your notes branch?\n"
+        "You can also type the beginning of its name to search.\n"
+        f"{answer_data['text']}",
+        reply_markup=answer_data["keyboard"],
+    )
+
+
+@form_router.message(RegisterForm.notes_branch, F.text)
+async def search_notes_branch(message: Message, state: FSMContext) -> None:
+    register_data = await state.get_data()
+    picker = BranchPicker(
+        token=register_data.get("github_token"),
+        username=register_data.get("github_username"),
+        repository=register_data.get("notes_repository"),
+    )
+    answer_data = await picker.get_selection_keyboard(state, query=message.text)
+
     await message.answer(
-        "What is your notes branch?",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=keyboard,
-            resize_keyboard=True,
-        ),
+        answer_data["text"],
+        reply_markup=answer_data["keyboard"],
+    )
+
+
+@form_router.callback_query(BranchPicker.PageCallback.filter())
+async def navigate_notes_branch(
+    query: CallbackQuery,
+    callback_data: BranchPicker.PageCallback,
+    state: FSMContext,
+) -> None:
+    register_data = await state.get_data()
+    picker = BranchPicker(
+        token=register_data.get("github_token"),
+        username=register_data.get("github_username"),
+        repository=register_data.get("notes_repository"),
+    )
+    answer_data = await picker.get_selection_keyboard(
+        state, callback_data.page, callback_data.query
+    )
+
+    await query.message.edit_text(
+        answer_data["text"], reply_markup=answer_data["keyboard"]
     )
 
 
@@ -454,9 +753,18 @@ class AssentFolderSelector(GithubFolderSelection, prefix="afs"):
     ...
 
 
-@form_router.message(RegisterForm.notes_branch)
-async def process_notes_branch(message: Message, state: FSMContext) -> None:
-    branch = message.text
+@form_router.callback_query(BranchPicker.SelectCallback.filter())
+async def process_notes_branch(
+    query: CallbackQuery,
+    callback_data: BranchPicker.SelectCallback,
+    state: FSMContext,
+    callback_answer: CallbackAnswer,
+) -> None:
+    branch = await BranchPicker.get_selected_name(state, callback_data)
+    if branch is None:
+        callback_answer.text = "This list is outdated, please search again."
+        return
+
     await state.update_data(notes_branch=branch)
     await state.set_state(RegisterForm.note_path)
 
@@ -468,12 +776,12 @@ async def process_notes_branch(message: Message, state: FSMContext) -> None:
     )
     answer_data = await selector.get_selection_keyboard()
 
-    await message.answer(
+    await query.message.edit_text(
+        f"Branch: {html.quote(branch)}\n"
         "And finally, in which file would you like to store your notes?",
-        reply_markup=ReplyKeyboardRemove(),
     )
 
-    await message.answer(
+    await query.message.answer(
         answer_data["text"],
         reply_markup=answer_data["keyboard"],
     )
@@ -598,6 +906,7 @@ class RegistrationVerifier(object):
                 message: Message,
                 state: FSMContext,
                 session: AsyncSession,
+                **kwargs,
             ) -> None:
                 dal = UserDAL(session)
                 user = await dal.get_user_by_id(message.from_user.id)
@@ -606,7 +915,7 @@ class RegistrationVerifier(object):
                     return
 
                 await state.set_state(RegisterForm.register_end)
-                await func(message=message, session=session, state=state)
+                await func(message=message, session=session, state=state, **kwargs)
 
             return wrap
 
@@ -616,60 +925,376 @@ class RegistrationVerifier(object):
 verify_register = RegistrationVerifier(RegisterForm.register_end)
 
 
+# inclusive bounds of numeric photo settings
+PHOTO_SETTING_RANGES = {
+    "max_side": (1, 10000),
+    "quality": (1, 100),
+    "thumbnail_side": (0, 10000),
+}
+
+
+@verify_register(form_router.message, Command("photo_settings"))
+async def photo_settings(
+    message: Message, session: AsyncSession, command: CommandObject, **kwargs
+) -> None:
+    """
+    Show or change photo processing, usage example:
+    /photo_settings max_side=1600 quality=80 format=webp thumbnail_side=320
+    """
+    dal = UserDAL(session)
+    formats = [*ImageSettings.Config.formats, ImageSettings.Config.original_format]
+
+    if command.args:
+        values = {}
+        try:
+            for option in command.args.split():
+                key, value = option.split("=", 1)
+                if key == "format":
+                    if value not in formats:
+                        raise ValueError(value)
+                    values["image_format"] = value
+                elif key in PHOTO_SETTING_RANGES:
+                    low, high = PHOTO_SETTING_RANGES[key]
+                    number = int(value)
+                    if not low <= number <= high:
+                        raise ValueError(value)
+                    values[f"image_{key}"] = number
+                else:
+                    raise ValueError(key)
+        except ValueError:
+            await message.answer(
+                "Can not parse settings, usage example:\n"
+                "/photo_settings max_side=1600 quality=80 format=webp "
+                "thumbnail_side=320\n"
+                f"Available formats: {', '.join(formats)}\n"
+                "Sides are positive, quality is from 1 to 100, "
+                "thumbnail_side=0 turns thumbnails off"
+            )
+            return
+
+        await dal.update_user(message.from_user.id, **values)
+        await session.commit()
+
+    user = await dal.get_user_by_id(message.from_user.id)
+    settings = ImageSettings.create_from_orm(user, config.images)
+    await message.answer(
+        "Photo settings:\n"
+        f"max side: {settings.max_side}\n"
+        f"quality: {settings.quality}\n"
+        f"format: {settings.format}\n"
+        f"thumbnail side: {settings.thumbnail_side or 'off'}"
+    )
+
+
+@verify_register(form_router.message, Command("route"))
+async def route_notes(
+    message: Message, session: AsyncSession, command: CommandObject, **kwargs
+) -> None:
+    """
+    Route notes with a tag to another file, usage example:
+    /route #todo todo.md - notes with #todo go to todo.md
+    /route #todo - notes with #todo go to the default file again
+    /route - show all routes
+    """
+    dal = UserDAL(session)
+    user = await dal.get_user_by_id(message.from_user.id)
+    routes = json.loads(user.note_routes) if user.note_routes else {}
+
+    args = command.args.split(maxsplit=1) if command.args else []
+    if args:
+        tag = args[0].casefold()
+        if not NoteUser.TAG_PATTERN.fullmatch(tag):
+            await message.answer("Usage example: /route #todo todo.md")
+            return
+
+        if len(args) > 1:
+            file_path = args[1].strip().lstrip("/")
+            if not NoteUser.is_valid_note_path(file_path):
+                await message.answer(
+                    "The file must be inside the repository, "
+                    "usage example: /route #todo todo.md"
+                )
+                return
+            routes[tag] = file_path
+        else:
+            routes.pop(tag, None)
+
+        await dal.update_user(message.from_user.id, note_routes=json.dumps(routes))
+        await session.commit()
+
+    lines = [f"{html.quote(tag)} -> {html.quote(path)}" for tag, path in routes.items()]
+    lines.append(f"everything else -> {html.quote(user.note_path or '')}")
+    await message.answer("Notes routes:\n" + "\n".join(lines))
+
+
+@verify_register(form_router.message, Command("compact_history"))
+async def compact_history(
+    message: Message, session: AsyncSession, command: CommandObject, **kwargs
+) -> None:
+    """
+    Squash bot commits older than some days into one commit per day,
+    usage example:
+    /compact_history 30 - compact commits older than 30 days
+    /compact_history off - stop compacting
+    """
+    dal = UserDAL(session)
+    if command.args:
+        args = command.args.strip()
+        if args == "off":
+            days = None
+        elif args.isdigit() and int(args) > 0:
+            days = int(args)
+        else:
+            await message.answer("Usage example: /compact_history 30")
+            return
+
+        await dal.update_user(message.from_user.id, compact_after_days=days)
+        await session.commit()
+
+    user = await dal.get_user_by_id(message.from_user.id)
+    if user.compact_after_days is None:
+        await message.answer("History compaction is off.")
+        return
+
+    await message.answer(
+        "Bot commits older than "
+        f"{user.compact_after_days} days are squashed into daily commits."
+    )
+
+
+@verify_register(form_router.message, Command("search"))
+async def search_notes(
+    message: Message, session: AsyncSession, command: CommandObject, **kwargs
+) -> None:
+    """
+    Search appended notes without touching github, usage example:
+    /search buy milk
+    """
+    if not command.args:
+        await message.answer("Usage example: /search buy milk")
+        return
+
+    entries = await NoteIndexDAL(session).search(message.from_user.id, command.args)
+    if not entries:
+        await message.answer("Nothing found.")
+        return
+
+    max_length = 200
+    results = []
+    for entry in entries:
+        content = entry.content
+        if len(content) > max_length:
+            content = content[:max_length] + "..."
+        created_at = entry.created_at.strftime("%Y-%m-%d %H:%M")
+        results.append(f"<b>{created_at}</b>\n{html.quote(content)}")
+
+    await message.answer("\n\n".join(results))
+
+
+@verify_register(form_router.message, Command("import"))
+async def import_chat(
+    message: Message, session: AsyncSession, chat_importer: ChatImporter, **kwargs
+) -> None:
+    """
+    Import a Telegram Desktop chat export into notes, send result.json or
+    a zip of the export folder (with photos) with /import as the caption.
+    /import alone continues the last unfinished import.
+    """
+    user_id = message.from_user.id
+    if chat_importer.is_running(user_id):
+        await message.answer("Import is already running.")
+        return
+
+    document = message.document
+    if document is None and message.reply_to_message is not None:
+        document = message.reply_to_message.document
+
+    dal = ImportDAL(session)
+    if document is None:
+        chat_import = await dal.get_unfinished_import(user_id)
+        if chat_import is None:
+            await message.answer(
+                "Send result.json or a zip of the Telegram Desktop chat export "
+                "with /import as the caption."
+            )
+            return
+        await dal.update_import(chat_import.id, status="running")
+    else:
+        if Path(document.file_name or "").suffix.lower() not in (".json", ".zip"):
+            await message.answer("Only result.json or a zip export can be imported.")
+            return
+        if (
+            not message.bot.session.api.is_local
+            and (document.file_size or 0) > ChatImporter.CLOUD_DOWNLOAD_LIMIT
+        ):
+            await message.answer(
+                "Bots can download files up to "
+                f"{ChatImporter.CLOUD_DOWNLOAD_LIMIT // (1024 * 1024)} MB "
+                "from Telegram. Send result.json alone or an export without "
+                "media, larger exports need a local Bot API server."
+            )
+            return
+
+        chat_import = await dal.get_import_by_file(user_id, document.file_unique_id)
+        if chat_import is None:
+            chat_import = await dal.create_import(
+                user_id,
+                file_id=document.file_id,
+                file_unique_id=document.file_unique_id,
+                file_name=document.file_name,
+            )
+        elif chat_import.status == "done":
+            await message.answer("This export is already imported.")
+            return
+        else:
+            await dal.update_import(
+                chat_import.id, file_id=document.file_id, status="running"
+            )
+    await session.commit()
+
+    if chat_import.last_message_id is None:
+        status_message = await message.answer("Import started...")
+    else:
+        status_message = await message.answer(
+            f"Continuing import after {chat_import.processed_messages} messages..."
+        )
+    chat_importer.start(message.bot, user_id, chat_import.id, status_message)
+
+
 @verify_register(form_router.message, F.text)
-async def add_note(message: Message, session: AsyncSession, **kwargs) -> None:
+async def add_note(
+    message: Message, session: AsyncSession, note_storage, **kwargs
+) -> None:
     dal = UserDAL(session)
     user = await dal.get_user_by_id(message.from_user.id)
-    note_user = NoteUser.create_from_orm(user)
-    await note_user.append_note(message.text)
+    note_user = NoteUser.create_from_orm(user, storage=note_storage)
+    commit_sha = await note_user.append_note(message.text)
+
+    await NoteIndexDAL(session).add_note(
+        user_id=user.user_id,
+        content=message.text,
+        commit_sha=commit_sha,
+        note_path=note_user.get_note_path(message.text),
+    )
+    await session.commit()
 
 
 @verify_register(form_router.message, F.photo)
-async def upload_photo(message: Message, session: AsyncSession, **kwargs) -> None:
+async def upload_photo(
+    message: Message,
+    session: AsyncSession,
+    note_storage,
+    image_pipeline: ImagePipeline,
+    media_budget: ByteBudget,
+    **kwargs,
+) -> None:
     dal = UserDAL(session)
     user = await dal.get_user_by_id(message.from_user.id)
-    note_user = NoteUser.create_from_orm(user)
+    note_user = NoteUser.create_from_orm(user, storage=note_storage)
+    settings = ImageSettings.create_from_orm(user, config.images)
+
+    with tracer.span("telegram.get_file", kind="photo"):
+        photo = await message.bot.get_file(message.photo[-1].file_id)
+    async with media_budget.reserve(photo.file_size):
+        if not settings.is_enabled:
+            # nothing to recompress, stream photo straight into the repository,
+            # the download goes on while the upload reads it
+            with tracer.span("telegram.download_file", kind="photo", streamed=True):
+                await note_user.upload_photo(
+                    MediaStream.from_telegram(
+                        message.bot, photo.file_path, size=photo.file_size
+                    )
+                )
+            return
 
-    photo = await message.bot.get_file(message.photo[-1].file_id)
-    photo_b = await message.bot.download_file(photo.file_path)
+        with tracer.span("telegram.download_file", kind="photo"):
+            photo_b = await message.bot.download_file(photo.file_path)
 
-    await note_user.upload_photo(photo_b)
+        processed = await image_pipeline.process(photo_b.read(), settings)
+
+        await note_user.upload_photo(
+            BytesIO(processed.content),
+            extension=processed.extension,
+            thumbnail=processed.thumbnail,
+        )
 
 
 @verify_register(form_router.message, F.voice)
 async def add_note_from_voice(
-    message: Message, session: AsyncSession, **kwargs
+    message: Message,
+    session: AsyncSession,
+    note_storage,
+    transcriber: Transcriber,
+    **kwargs,
 ) -> None:
     dal = UserDAL(session)
     user = await dal.get_user_by_id(message.from_user.id)
-    note_user = NoteUser.create_from_orm(user)
+    note_user = NoteUser.create_from_orm(user, storage=note_storage)
+    # ends the transaction, so no connection is held idle through the queue
+    await session.commit()
 
     fname = f"{message.from_user.id}_{message.message_id}.mp3"
-    voice = await message.bot.get_file(message.voice.file_id)
-    await message.bot.download_file(voice.file_path, fname)
+    with tracer.span("telegram.download_file", kind="voice"):
+        voice = await message.bot.get_file(message.voice.file_id)
+        await message.bot.download_file(voice.file_path, fname)
 
-    result = whisper_model.transcribe(fname)
-    os.remove(fname)
+    try:
+        with tracer.span("whisper.transcribe", duration=message.voice.duration) as span:
+            result = await transcriber.transcribe(
+                fname, duration=message.voice.duration
+            )
+            span.set_attribute("model", result.model)
+    finally:
+        os.remove(fname)
+
+    commit_sha = await note_user.append_note(result.text)
+
+    await NoteIndexDAL(session).add_note(
+        user_id=user.user_id,
+        content=result.text,
+        commit_sha=commit_sha,
+        note_path=note_user.get_note_path(result.text),
+        transcription_model=result.model,
+    )
+    await session.commit()
 
-    await note_user.append_note(result["text"])
 
+@form_router.errors(ExceptionTypeFilter(RepositoryLockTimeout), F.update.message)
+async def repository_busy(event: ErrorEvent) -> None:
+    """the note was not saved and the update is acknowledged, ask to resend"""
+    logging.warning("Note is not saved: %s", event.exception)
+    await event.update.message.reply(
+        "Your notes repository is busy, the note was not saved. "
+        "Please send it again in a minute."
+    )
 
-async def main():
-    engine = create_async_engine(url=config.db.db_url, echo=True)
-    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
 
-    bot = Bot(token=config.bot.token, parse_mode=ParseMode.HTML)
-    dp = Dispatcher()
+async def main():
+    async with bot_runtime(form_router, config.monitoring.metrics_port) as (bot, dp):
+        await dp.start_polling(bot)
 
-    dp.update.middleware(DbSessionMiddleware(session_pool=sessionmaker))
-    # Automatically reply to all callbacks
-    dp.callback_query.middleware(CallbackAnswerMiddleware())
 
-    dp.include_router(form_router)
+async def supervisor_main():
+    bot = Bot(token=config.bot.token, parse_mode=ParseMode.HTML)
+    supervisor = ShardSupervisor(config.dispatching.workers, run_shard_worker)
+    if config.monitoring.metrics_port:
+        await metrics.start_server(
+            config.monitoring.metrics_host, config.monitoring.metrics_port
+        )
 
-    await dp.start_polling(bot)
+    supervisor.start()
+    try:
+        await supervisor.poll(
+            bot, allowed_updates=form_router.resolve_used_update_types()
+        )
+    finally:
+        await asyncio.to_thread(supervisor.stop)
+        await bot.session.close()
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    asyncio.run(main())
+    if config.dispatching.workers > 1:
+        asyncio.run(supervisor_main())
+    else:
+        asyncio.run(main())
@@ -5,6 +5,7 @@ from envparse import Env
 @dataclass
 class Bot:
     token: str
+    admin_ids: list[int]
 
 
 @dataclass
@@ -34,10 +35,131 @@ class DB:
         )
 
 
+@dataclass
+class Storage:
+    mode: str
+    mirror_path: str
+    mirror_max_repos: int
+    mirror_push_batch: int
+    mirror_push_interval: float
+    graphql_url: str
+    # seconds a note waits for others to share its commit, 0 commits at once
+    buffer_delay: float
+    buffer_max_notes: int
+    lock_timeout: float
+    # 0 fits every commit the lanes of a process can run at once
+    lock_pool_size: int
+
+    class Config:
+        modes = ("api", "mirror", "graphql")
+
+
+@dataclass
+class Images:
+    workers: int
+    max_side: int
+    quality: int
+    format: str
+    thumbnail_side: int
+    budget_bytes: int
+
+
+@dataclass
+class Imports:
+    batch_size: int
+    batch_bytes: int
+    progress_interval: float
+
+
+@dataclass
+class Tracing:
+    exporter: str
+    path: str
+    otlp_endpoint: str
+    sample_ratio: float
+    export_interval: float
+
+    class Config:
+        exporters = ("none", "jsonl", "otlp")
+
+
+@dataclass
+class Monitoring:
+    metrics_host: str
+    metrics_port: int
+    stall_threshold: float
+    stall_check_interval: float
+
+
+@dataclass
+class Sending:
+    global_rate: float
+    chat_rate: float
+    chat_burst: int
+    group_rate: float
+    max_retries: int
+
+
+@dataclass
+class Ledger:
+    cache_size: int
+    flush_interval: float
+    retention_hours: float
+
+
+@dataclass
+class Compaction:
+    interval_hours: float
+    path: str
+
+
+@dataclass
+class Transcription:
+    # more models let it step down under load, but every shard worker
+    # loads each of them
+    models: list[str]
+    latency_target: float
+    workers: int
+
+
+@dataclass
+class Lane:
+    priority: int
+    limit: int
+
+
+@dataclass
+class Dispatching:
+    workers: int
+    total_limit: int
+    lanes: dict[str, Lane]
+
+    class Config:
+        # lane name -> default priority (lower runs first) and concurrency limit
+        lanes = {
+            "interactive": Lane(priority=0, limit=16),
+            "text": Lane(priority=1, limit=8),
+            "media": Lane(priority=2, limit=4),
+            # voice handlers mostly wait in the transcriber queue, it has to
+            # see the backlog to step down to faster models
+            "voice": Lane(priority=3, limit=8),
+        }
+
+
 @dataclass
 class Config:
     bot: Bot
     db: DB
+    storage: Storage
+    images: Images
+    imports: Imports
+    tracing: Tracing
+    monitoring: Monitoring
+    dispatching: Dispatching
+    sending: Sending
+    ledger: Ledger
+    compaction: Compaction
+    transcription: Transcription
 
 
 def load_config():
@@ -45,7 +167,10 @@ def load_config():
     env.read_envfile()
 
     return Config(
-        bot=Bot(token=env.str("BOT_TOKEN")),
+        bot=Bot(
+            token=env.str("BOT_TOKEN"),
+            admin_ids=env.list("ADMIN_IDS", default=[], subcast=int),
+        ),
         db=DB(
             host=env.str("DB_HOST"),
             port=env.str("DB_PORT"),
@@ -53,4 +178,80 @@ def load_config():
             user=env.str("DB_USER"),
             password=env.str("DB_PASSWORD"),
         ),
+        storage=Storage(
+            mode=env.str("STORAGE_MODE", default="api"),
+            mirror_path=env.str("MIRROR_PATH", default=".mirrors"),
+            mirror_max_repos=env.int("MIRROR_MAX_REPOS", default=32),
+            mirror_push_batch=env.int("MIRROR_PUSH_BATCH", default=10),
+            mirror_push_interval=env.float("MIRROR_PUSH_INTERVAL", default=30),
+            graphql_url=env.str(
+                "GITHUB_GRAPHQL_URL", default="https://api.github.com/graphql"
+            ),
+            buffer_delay=env.float("NOTE_BUFFER_DELAY", default=0),
+            buffer_max_notes=env.int("NOTE_BUFFER_MAX_NOTES", default=50),
+            lock_timeout=env.float("REPOSITORY_LOCK_TIMEOUT", default=30),
+            lock_pool_size=env.int("REPOSITORY_LOCK_POOL_SIZE", default=0),
+        ),
+        images=Images(
+            workers=env.int("IMAGE_WORKERS", default=2),
+            max_side=env.int("IMAGE_MAX_SIDE", default=2048),
+            quality=env.int("IMAGE_QUALITY", default=82),
+            format=env.str("IMAGE_FORMAT", default="jpeg"),
+            thumbnail_side=env.int("IMAGE_THUMBNAIL_SIDE", default=0),
+            budget_bytes=env.int("MEDIA_BYTES_BUDGET", default=64 * 1024 * 1024),
+        ),
+        imports=Imports(
+            batch_size=env.int("IMPORT_BATCH_SIZE", default=500),
+            batch_bytes=env.int("IMPORT_BATCH_BYTES", default=32 * 1024 * 1024),
+            progress_interval=env.float("IMPORT_PROGRESS_INTERVAL", default=5),
+        ),
+        tracing=Tracing(
+            exporter=env.str("TRACING_EXPORTER", default="none"),
+            path=env.str("TRACING_PATH", default="traces.jsonl"),
+            otlp_endpoint=env.str(
+                "TRACING_OTLP_ENDPOINT", default="http://localhost:4318/v1/traces"
+            ),
+            sample_ratio=env.float("TRACING_SAMPLE_RATIO", default=1.0),
+            export_interval=env.float("TRACING_EXPORT_INTERVAL", default=5),
+        ),
+        monitoring=Monitoring(
+            metrics_host=env.str("METRICS_HOST", default="0.0.0.0"),
+            metrics_port=env.int("METRICS_PORT", default=0),
+            stall_threshold=env.float("LOOP_STALL_THRESHOLD", default=0.5),
+            stall_check_interval=env.float("LOOP_STALL_CHECK_INTERVAL", default=0.1),
+        ),
+        dispatching=Dispatching(
+            workers=env.int("DISPATCHER_WORKERS", default=0),
+            total_limit=env.int("LANES_TOTAL_LIMIT", default=24),
+            lanes={
+                name: Lane(
+                    priority=env.int(
+                        f"LANE_{name.upper()}_PRIORITY", default=lane.priority
+                    ),
+                    limit=env.int(f"LANE_{name.upper()}_LIMIT", default=lane.limit),
+                )
+                for name, lane in Dispatching.Config.lanes.items()
+            },
+        ),
+        sending=Sending(
+            global_rate=env.float("SEND_GLOBAL_RATE", default=30),
+            chat_rate=env.float("SEND_CHAT_RATE", default=1),
+            chat_burst=env.int("SEND_CHAT_BURST", default=3),
+            group_rate=env.float("SEND_GROUP_RATE", default=20 / 60),
+            max_retries=env.int("SEND_MAX_RETRIES", default=3),
+        ),
+        ledger=Ledger(
+            cache_size=env.int("LEDGER_CACHE_SIZE", default=100_000),
+            flush_interval=env.float("LEDGER_FLUSH_INTERVAL", default=1.0),
+            retention_hours=env.float("LEDGER_RETENTION_HOURS", default=48),
+        ),
+        compaction=Compaction(
+            interval_hours=env.float("COMPACTION_INTERVAL_HOURS", default=0),
+            path=env.str("COMPACTION_PATH", default=None),
+        ),
+        transcription=Transcription(
+            models=env.list("WHISPER_MODELS", default=["base"]),
+            latency_target=env.float("WHISPER_LATENCY_TARGET", default=30),
+            workers=env.int("WHISPER_WORKERS", default=1),
+        ),
     )
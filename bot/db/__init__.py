@@ -1,4 +1,4 @@
 from .base import Base
-from .models import User
+from .models import ChatImport, NoteIndexEntry, ProcessedUpdate, User
 
-__all__ = ["Base", "User"]
+__all__ = ["Base", "ChatImport", "NoteIndexEntry", "ProcessedUpdate", "User"]
@@ -1,4 +1,18 @@
-from sqlalchemy import Column, BigInteger, String, Boolean
+from sqlalchemy import (
+    Column,
+    BigInteger,
+    Integer,
+    String,
+    Boolean,
+    Computed,
+    DateTime,
+    ForeignKey,
+    Index,
+    Text,
+    UniqueConstraint,
+    func,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 from bot.db.base import Base
 
@@ -13,3 +27,68 @@ class User(Base):
     notes_branch = Column(String(50))
     assets_folder = Column(String(300))
     is_registered = Column(Boolean(False))
+    image_max_side = Column(Integer)
+    image_quality = Column(Integer)
+    image_format = Column(String(10))
+    image_thumbnail_side = Column(Integer)
+    notes_backfilled = Column(Boolean, default=False)
+    # json object mapping lowercase "#tag" to the file notes with it go to
+    note_routes = Column(Text)
+    # bot commits older than this are squashed into daily commits, None is off
+    compact_after_days = Column(Integer)
+
+
+class NoteIndexEntry(Base):
+    __tablename__ = "notes_index"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(
+        BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False
+    )
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    commit_sha = Column(String(40))
+    note_path = Column(String(300))
+    content = Column(Text, nullable=False)
+    # whisper model of notes made from voice messages
+    transcription_model = Column(String(30))
+    content_tsv = Column(
+        TSVECTOR, Computed("to_tsvector('simple', content)", persisted=True)
+    )
+
+    __table_args__ = (
+        Index("ix_notes_index_user_id_created_at", "user_id", "created_at"),
+        Index("ix_notes_index_content_tsv", "content_tsv", postgresql_using="gin"),
+    )
+
+
+class ChatImport(Base):
+    __tablename__ = "imports"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(
+        BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False
+    )
+    file_id = Column(String(200), nullable=False)
+    file_unique_id = Column(String(100), nullable=False)
+    file_name = Column(String(300))
+    # running, failed, interrupted or done
+    status = Column(String(20), nullable=False)
+    processed_messages = Column(Integer, nullable=False, default=0)
+    # id of the last message which is already committed to the repository
+    last_message_id = Column(BigInteger)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+    __table_args__ = (UniqueConstraint("user_id", "file_unique_id"),)
+
+
+class ProcessedUpdate(Base):
+    __tablename__ = "processed_updates"
+
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    message_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (Index("ix_processed_updates_processed_at", "processed_at"),)
@@ -1,3 +1,15 @@
 from .db import DbSessionMiddleware
+from .lanes import LanesMiddleware
+from .send_queue import SendQueueMiddleware
+from .tracing import TracingMiddleware
+from .update_ledger import UpdateLedgerMiddleware
+from .watchdog import LoopWatchdogMiddleware
 
-__all__ = ["DbSessionMiddleware"]
+__all__ = [
+    "DbSessionMiddleware",
+    "LanesMiddleware",
+    "LoopWatchdogMiddleware",
+    "SendQueueMiddleware",
+    "TracingMiddleware",
+    "UpdateLedgerMiddleware",
+]
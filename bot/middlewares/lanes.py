@@ -0,0 +1,21 @@
+from typing import Callable, Awaitable, Dict, Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from bot.services.lanes import LaneScheduler, classify_update
+
+
+class LanesMiddleware(BaseMiddleware):
+    def __init__(self, scheduler: LaneScheduler):
+        super().__init__()
+        self.scheduler = scheduler
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self.scheduler.slot(classify_update(event)):
+            return await handler(event, data)
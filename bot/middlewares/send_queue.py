@@ -0,0 +1,22 @@
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from bot.services.send_queue import SendQueue
+
+
+class SendQueueMiddleware(BaseRequestMiddleware):
+    def __init__(self, queue: SendQueue):
+        self.queue = queue
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        return await self.queue.send(make_request, bot, method)
@@ -0,0 +1,25 @@
+from typing import Callable, Awaitable, Dict, Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from bot.services.tracing import tracer
+
+
+class TracingMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        with tracer.span("telegram.update") as span:
+            if isinstance(event, Update):
+                span.set_attribute("update.id", event.update_id)
+                span.set_attribute("update.type", event.event_type)
+
+            user = data.get("event_from_user")
+            if user is not None:
+                span.set_attribute("user.id", user.id)
+
+            return await handler(event, data)
@@ -0,0 +1,32 @@
+from typing import Callable, Awaitable, Dict, Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+from bot.services.update_ledger import UpdateLedger
+
+
+class UpdateLedgerMiddleware(BaseMiddleware):
+    """skip messages which were already handled successfully"""
+
+    def __init__(self, ledger: UpdateLedger):
+        super().__init__()
+        self.ledger = ledger
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        key = (event.chat.id, event.message_id)
+        if not await self.ledger.start(key, sent_at=event.date):
+            return None
+
+        succeeded = False
+        try:
+            result = await handler(event, data)
+            succeeded = True
+            return result
+        finally:
+            self.ledger.finish(key, succeeded)
@@ -0,0 +1,34 @@
+import asyncio
+from typing import Callable, Awaitable, Dict, Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from bot.services.loop_watchdog import LoopWatchdog
+
+
+class LoopWatchdogMiddleware(BaseMiddleware):
+    """let the watchdog know which handler and user a task is serving"""
+
+    def __init__(self, watchdog: LoopWatchdog):
+        super().__init__()
+        self.watchdog = watchdog
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        handler_name = (
+            handler_object.callback.__name__ if handler_object is not None else None
+        )
+        user = data.get("event_from_user")
+
+        task = asyncio.current_task()
+        self.watchdog.track(task, handler_name, user.id if user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            self.watchdog.untrack(task)
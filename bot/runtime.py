@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import sys
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.enums import ParseMode
+from aiogram.utils.callback_answer import CallbackAnswerMiddleware
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from bot.config import config
+from bot.middlewares import (
+    DbSessionMiddleware,
+    LanesMiddleware,
+    LoopWatchdogMiddleware,
+    SendQueueMiddleware,
+    TracingMiddleware,
+    UpdateLedgerMiddleware,
+)
+from bot.services.chat_import import ChatImporter
+from bot.services.git_mirror import GitMirrorCache, MirrorNoteStorage
+from bot.services.github_graphql import GithubGraphQL, GraphQLNoteStorage
+from bot.services.history_compaction import HistoryCompactor
+from bot.services.image_pipeline import ImagePipeline
+from bot.services.lanes import LaneScheduler
+from bot.services.loop_watchdog import LoopWatchdog
+from bot.services.media_stream import ByteBudget
+from bot.services.metrics import metrics
+from bot.services.note_appender import RestNoteStorage
+from bot.services.note_buffer import BufferedNoteStorage
+from bot.services.repository_lock import LockedNoteStorage, RepositoryLocker
+from bot.services.send_queue import SendQueue
+from bot.services.sharding import ShardWorker
+from bot.services.tracing import JsonLinesExporter, OTLPHttpExporter, tracer
+from bot.services.transcriber import Transcriber
+from bot.services.update_ledger import UpdateLedger
+
+
+# locks taken besides the handlers: chat imports, compaction, mirror pushes
+BACKGROUND_LOCKS = 4
+
+
+def create_note_storage(storage_config, locker: RepositoryLocker = None):
+    storage = create_commit_storage(storage_config, locker)
+    # mirrors change the remote only when pushing and lock around the push
+    if locker is not None and storage_config.mode != "mirror":
+        storage = LockedNoteStorage(storage, locker)
+
+    if storage_config.buffer_delay <= 0:
+        return storage
+
+    return BufferedNoteStorage(
+        storage,
+        delay=storage_config.buffer_delay,
+        max_notes=storage_config.buffer_max_notes,
+    )
+
+
+def create_commit_storage(storage_config, locker: RepositoryLocker = None):
+    if storage_config.mode == "mirror":
+        cache = GitMirrorCache(
+            root=storage_config.mirror_path,
+            max_mirrors=storage_config.mirror_max_repos,
+            push_batch_size=storage_config.mirror_push_batch,
+            push_interval=storage_config.mirror_push_interval,
+            locker=locker,
+        )
+        return MirrorNoteStorage(cache)
+
+    if storage_config.mode == "graphql":
+        return GraphQLNoteStorage(GithubGraphQL(endpoint=storage_config.graphql_url))
+
+    if storage_config.mode == "api":
+        return RestNoteStorage()
+
+    raise ValueError(
+        f"Unknown storage mode {storage_config.mode!r}, "
+        f"available modes: {', '.join(storage_config.Config.modes)}"
+    )
+
+
+def configure_tracing(tracing_config):
+    if tracing_config.exporter == "none":
+        return
+
+    if tracing_config.exporter == "jsonl":
+        exporter = JsonLinesExporter(tracing_config.path)
+    elif tracing_config.exporter == "otlp":
+        exporter = OTLPHttpExporter(tracing_config.otlp_endpoint)
+    else:
+        raise ValueError(
+            f"Unknown tracing exporter {tracing_config.exporter!r}, "
+            f"available exporters: {', '.join(tracing_config.Config.exporters)}"
+        )
+
+    tracer.configure(exporter, sample_ratio=tracing_config.sample_ratio)
+
+
+@asynccontextmanager
+async def bot_runtime(router: Router, metrics_port=None, background_jobs=True):
+    """bot and dispatcher with every service needed to handle updates
+
+    Jobs which touch every user run only where background_jobs is set.
+    """
+
+    configure_tracing(config.tracing)
+    tracing_exporter = asyncio.create_task(
+        tracer.run_exporter(config.tracing.export_interval)
+    )
+    watchdog = LoopWatchdog(
+        threshold=config.monitoring.stall_threshold,
+        interval=config.monitoring.stall_check_interval,
+    )
+    watchdog_task = asyncio.create_task(watchdog.run())
+    if metrics_port:
+        await metrics.start_server(config.monitoring.metrics_host, metrics_port)
+
+    engine = create_async_engine(url=config.db.db_url, echo=True)
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    locker = None
+    if config.storage.lock_timeout > 0:
+        locker = RepositoryLocker.create(
+            config.db.db_url,
+            timeout=config.storage.lock_timeout,
+            # every shard worker runs lanes of its own, so the pool is per process
+            pool_size=config.storage.lock_pool_size
+            or config.dispatching.total_limit + BACKGROUND_LOCKS,
+        )
+    note_storage = create_note_storage(config.storage, locker)
+    image_pipeline = ImagePipeline(workers=config.images.workers)
+    media_budget = ByteBudget(config.images.budget_bytes)
+    update_ledger = UpdateLedger(
+        sessionmaker,
+        cache_size=config.ledger.cache_size,
+        flush_interval=config.ledger.flush_interval,
+        retention=timedelta(hours=config.ledger.retention_hours),
+    )
+    update_ledger_task = asyncio.create_task(update_ledger.run())
+    transcriber = Transcriber(
+        config.transcription.models,
+        latency_target=config.transcription.latency_target,
+        workers=config.transcription.workers,
+    )
+    transcriber.start()
+    chat_importer = ChatImporter(
+        sessionmaker,
+        note_storage,
+        batch_size=config.imports.batch_size,
+        batch_bytes=config.imports.batch_bytes,
+        progress_interval=config.imports.progress_interval,
+    )
+
+    bot = Bot(token=config.bot.token, parse_mode=ParseMode.HTML)
+    # every shard worker sends through its own queue, so they share the limit
+    workers = max(config.dispatching.workers, 1)
+    bot.session.middleware(
+        SendQueueMiddleware(
+            SendQueue(
+                global_rate=config.sending.global_rate / workers,
+                chat_rate=config.sending.chat_rate,
+                chat_burst=config.sending.chat_burst,
+                group_rate=config.sending.group_rate,
+                max_retries=config.sending.max_retries,
+            )
+        )
+    )
+    dp = Dispatcher(
+        note_storage=note_storage,
+        image_pipeline=image_pipeline,
+        media_budget=media_budget,
+        chat_importer=chat_importer,
+        transcriber=transcriber,
+    )
+
+    dp.update.outer_middleware(TracingMiddleware())
+    dp.update.outer_middleware(
+        LanesMiddleware(
+            LaneScheduler(
+                lanes=config.dispatching.lanes,
+                total_limit=config.dispatching.total_limit,
+            )
+        )
+    )
+    dp.update.middleware(DbSessionMiddleware(session_pool=sessionmaker))
+    dp.message.middleware(UpdateLedgerMiddleware(update_ledger))
+    dp.message.middleware(LoopWatchdogMiddleware(watchdog))
+    dp.callback_query.middleware(LoopWatchdogMiddleware(watchdog))
+    # Automatically reply to all callbacks
+    dp.callback_query.middleware(CallbackAnswerMiddleware())
+
+    dp.include_router(router)
+
+    compactor_task = None
+    if background_jobs and config.compaction.interval_hours > 0:
+        compactor = HistoryCompactor(
+            sessionmaker,
+            bot,
+            locker=locker,
+            interval=config.compaction.interval_hours * 3600,
+            root=config.compaction.path,
+        )
+        compactor_task = asyncio.create_task(compactor.run())
+
+    try:
+        yield bot, dp
+    finally:
+        if compactor_task is not None:
+            compactor_task.cancel()
+            await asyncio.gather(compactor_task, return_exceptions=True)
+        await chat_importer.close()
+        await transcriber.close()
+        update_ledger_task.cancel()
+        await asyncio.gather(update_ledger_task, return_exceptions=True)
+        await note_storage.close()
+        if locker is not None:
+            await locker.close()
+        await bot.session.close()
+        image_pipeline.close()
+        tracing_exporter.cancel()
+        watchdog_task.cancel()
+        await asyncio.gather(tracing_exporter, return_exceptions=True)
+
+
+async def shard_worker_main(shard, updates_queue, acks_queue):
+    metrics_port = None
+    if config.monitoring.metrics_port:
+        metrics_port = config.monitoring.metrics_port + shard + 1
+
+    # spawn does not run the entry point again, so the handlers are
+    # imported here rather than passed from the supervisor
+    from bot.__main__ import form_router
+
+    runtime = bot_runtime(form_router, metrics_port, background_jobs=shard == 0)
+    async with runtime as (bot, dp):
+        await ShardWorker(shard, updates_queue, acks_queue).run(bot, dp)
+
+
+def run_shard_worker(shard, updates_queue, acks_queue):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(shard_worker_main(shard, updates_queue, acks_queue))
@@ -0,0 +1,369 @@
+import asyncio
+import contextvars
+import logging
+import os
+import re
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timezone
+from itertools import islice
+from pathlib import Path, PurePosixPath
+from urllib.parse import quote
+
+import ijson
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+
+from bot.services.import_dal import ImportDAL
+from bot.services.media_stream import MediaStream
+from bot.services.metrics import metrics
+from bot.services.note_appender import NoteUser
+from bot.services.note_index_dal import NoteIndexDAL
+from bot.services.tracing import tracer
+from bot.services.user_dal import UserDAL
+
+imported_messages = metrics.counter(
+    "chat_import_messages_total", "Messages imported from telegram chat exports"
+)
+
+
+def render_text(text):
+    """plain text of an exported message, formatting entities are dropped"""
+
+    if isinstance(text, str):
+        return text
+    return "".join(part if isinstance(part, str) else part["text"] for part in text)
+
+
+def get_message_date(message: dict):
+    if "date_unixtime" in message:
+        return datetime.fromtimestamp(int(message["date_unixtime"]), timezone.utc)
+    return datetime.fromisoformat(message["date"])
+
+
+class AsyncFileReader(object):
+    """lets ijson read a blocking file without blocking the event loop"""
+
+    def __init__(self, file):
+        self.file = file
+
+    async def read(self, size=-1):
+        return await asyncio.to_thread(self.file.read, size)
+
+
+class TelegramExport(object):
+    """chat export of Telegram Desktop, result.json alone or zipped with media
+
+    Messages are parsed one by one, so memory use does not depend on the
+    size of the export.
+    """
+
+    RESULT_FILE = "result.json"
+    MEDIA_KEYS = ("photo", "file")
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = None
+        self.root = PurePosixPath()
+
+    def open_result(self):
+        if not zipfile.is_zipfile(self.path):
+            return open(self.path, "rb")
+
+        self.archive = zipfile.ZipFile(self.path)
+        names = [
+            name
+            for name in self.archive.namelist()
+            if PurePosixPath(name).name == self.RESULT_FILE
+        ]
+        if not names:
+            raise ValueError(f"There is no {self.RESULT_FILE} in the archive")
+
+        # the export folder is usually zipped as a whole, media paths are
+        # relative to the folder with result.json
+        result_name = min(names, key=len)
+        self.root = PurePosixPath(result_name).parent
+        return self.archive.open(result_name)
+
+    async def messages(self):
+        result = await asyncio.to_thread(self.open_result)
+        try:
+            async for message in ijson.items(AsyncFileReader(result), "messages.item"):
+                if message.get("type") == "message":
+                    yield message
+        finally:
+            result.close()
+
+    def get_media_info(self, media_path):
+        if self.archive is None or not media_path:
+            return None
+        try:
+            return self.archive.getinfo(str(self.root / media_path))
+        except KeyError:
+            return None
+
+    def get_media_size(self, message: dict):
+        """bytes of every exported media file of the message"""
+
+        infos = [self.get_media_info(message.get(key)) for key in self.MEDIA_KEYS]
+        return sum(info.file_size for info in infos if info is not None)
+
+    def open_media(self, media_path):
+        """stream of a media file, None when it was not exported"""
+
+        info = self.get_media_info(media_path)
+        if info is None:
+            return None
+
+        async def chunks(chunk_size=65536):
+            with self.archive.open(info) as file:
+                while chunk := await asyncio.to_thread(file.read, chunk_size):
+                    yield chunk
+
+        return MediaStream(chunks(), size=info.file_size)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+
+class ChatImporter(object):
+    """imports telegram chat exports in background, one import per user
+
+    Every ``batch_size`` messages, or fewer when their media add up to
+    ``batch_bytes``, go to the repository in one commit. The id of the last
+    committed message is saved after every commit, so a failed or
+    interrupted import continues right after it. The commit carries it
+    too, for a bot stopped between the commit and saving the id.
+    """
+
+    # trailers of import commits, found on the latest commits of the branch
+    COMMIT_TRAILER = re.compile(r"^Telegram-(Import|Last-Message|Processed): (\d+)$")
+    COMMITS_TO_SCAN = 30
+
+    # the cloud Bot API does not serve larger files, a local server does
+    CLOUD_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+
+    def __init__(
+        self,
+        sessionmaker,
+        storage,
+        batch_size: int = 500,
+        batch_bytes: int = 32 * 1024 * 1024,
+        progress_interval: float = 5,
+    ):
+        self.sessionmaker = sessionmaker
+        self.storage = storage
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.progress_interval = progress_interval
+        # user id -> task of the running import
+        self.tasks = {}
+
+    def is_running(self, user_id):
+        return user_id in self.tasks
+
+    def start(self, bot: Bot, user_id, import_id, status_message: Message):
+        # fresh context, so the whole import is not traced as this update
+        task = asyncio.create_task(
+            self.run(bot, user_id, import_id, status_message),
+            context=contextvars.Context(),
+        )
+        self.tasks[user_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(user_id, None))
+
+    async def report(self, status_message: Message, text):
+        try:
+            await status_message.edit_text(text)
+        except TelegramBadRequest:
+            logging.warning("Can not update import status: %s", text)
+
+    async def read_batches(self, export: TelegramExport, after_message_id=None):
+        batch = []
+        batch_bytes = 0
+        async for message in export.messages():
+            if after_message_id is not None and message["id"] <= after_message_id:
+                continue
+            message_bytes = export.get_media_size(message)
+            if batch and batch_bytes + message_bytes > self.batch_bytes:
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(message)
+            batch_bytes += message_bytes
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+
+    def get_committed_progress(self, note_user: NoteUser, import_id):
+        """last message id and processed messages of the newest commit of
+        the import, commits a mirror did not push yet are not seen"""
+
+        commits = note_user.remote_repo.get_commits(sha=note_user.branch)
+        for commit in islice(commits, self.COMMITS_TO_SCAN):
+            trailers = {}
+            for line in commit.commit.message.splitlines():
+                match = self.COMMIT_TRAILER.match(line)
+                if match:
+                    trailers[match[1]] = int(match[2])
+            if trailers.get("Import") == import_id:
+                return trailers["Last-Message"], trailers["Processed"]
+        return None
+
+    def render_batch(
+        self, note_user: NoteUser, export: TelegramExport, batch, assets_folder
+    ):
+        appends = defaultdict(list)
+        files = {}
+        notes = []
+        for message in batch:
+            lines = []
+            text = render_text(message.get("text", "")).strip()
+            if text:
+                lines.append(text)
+
+            for key in export.MEDIA_KEYS:
+                media = export.open_media(message.get(key))
+                if media is None:
+                    continue
+                name = PurePosixPath(message[key]).name
+                media_path = str(
+                    Path(assets_folder or "")
+                    / "telegram_import"
+                    / f"{message['id']}_{name}"
+                )
+                files[media_path] = media
+                link = quote(f"/{media_path}")
+                lines.append(f"![]({link})" if key == "photo" else f"[{name}]({link})")
+
+            if not lines:
+                continue
+            content = "\n".join(lines)
+            note_path = note_user.get_note_path(content)
+            appends[note_path].append(content)
+            notes.append((message, content, note_path))
+
+        appends = {path: "\n".join(contents) for path, contents in appends.items()}
+        return appends, files, notes
+
+    async def commit_batch(
+        self, session, user, note_user, export, batch, import_id, processed
+    ):
+        appends, files, notes = self.render_batch(
+            note_user, export, batch, user.assets_folder
+        )
+        if not notes:
+            return None
+
+        with tracer.span("import.commit_batch", messages=len(batch)):
+            commit_sha = await self.storage.commit(
+                note_user,
+                appends=appends or None,
+                files=files or None,
+                message=(
+                    f"Import {len(notes)} notes from telegram\n\n"
+                    f"Telegram-Import: {import_id}\n"
+                    f"Telegram-Last-Message: {batch[-1]['id']}\n"
+                    f"Telegram-Processed: {processed}"
+                ),
+            )
+
+        await NoteIndexDAL(session).add_notes(
+            [
+                {
+                    "user_id": user.user_id,
+                    "content": content,
+                    "commit_sha": commit_sha,
+                    "note_path": note_path,
+                    "created_at": get_message_date(message),
+                }
+                for message, content, note_path in notes
+            ]
+        )
+        return commit_sha
+
+    async def run(self, bot: Bot, user_id, import_id, status_message: Message):
+        async with self.sessionmaker() as session:
+            chat_import = await ImportDAL(session).get_import(import_id)
+            user = await UserDAL(session).get_user_by_id(user_id)
+        note_user = await asyncio.to_thread(
+            NoteUser.create_from_orm, user, storage=self.storage
+        )
+        processed = chat_import.processed_messages
+        last_message_id = chat_import.last_message_id
+
+        fd, path = tempfile.mkstemp(suffix=Path(chat_import.file_name or "").suffix)
+        os.close(fd)
+        export = TelegramExport(path)
+        status = "failed"
+        try:
+            with tracer.span("telegram.download_file", kind="import"):
+                await bot.download(chat_import.file_id, destination=path)
+
+            committed = await asyncio.to_thread(
+                self.get_committed_progress, note_user, import_id
+            )
+            if committed is not None and committed[0] > (last_message_id or 0):
+                # the last batch got committed, but its progress was not saved
+                last_message_id, processed = committed
+
+            reported_at = time.monotonic()
+            async for batch in self.read_batches(export, last_message_id):
+                async with self.sessionmaker() as session:
+                    await self.commit_batch(
+                        session,
+                        user,
+                        note_user,
+                        export,
+                        batch,
+                        import_id,
+                        processed=processed + len(batch),
+                    )
+                    processed += len(batch)
+                    last_message_id = batch[-1]["id"]
+                    await ImportDAL(session).update_import(
+                        import_id,
+                        processed_messages=processed,
+                        last_message_id=last_message_id,
+                    )
+                    await session.commit()
+                imported_messages.inc(len(batch))
+
+                if time.monotonic() - reported_at >= self.progress_interval:
+                    reported_at = time.monotonic()
+                    await self.report(
+                        status_message, f"Imported {processed} messages..."
+                    )
+
+            status = "done"
+            await self.report(
+                status_message, f"Import finished, {processed} messages imported."
+            )
+        except asyncio.CancelledError:
+            status = "interrupted"
+            raise
+        except Exception:
+            logging.exception("Import %s of user %s failed", import_id, user_id)
+            await self.report(
+                status_message,
+                f"Import failed after {processed} messages, "
+                "send /import to continue.",
+            )
+        finally:
+            export.close()
+            os.remove(path)
+            async with self.sessionmaker() as session:
+                await ImportDAL(session).update_import(import_id, status=status)
+                await session.commit()
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
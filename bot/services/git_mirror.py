@@ -0,0 +1,365 @@
+import asyncio
+import contextvars
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from contextlib import nullcontext
+from pathlib import Path
+
+from bot.services.media_stream import MediaStream
+from bot.services.note_appender import NoteAdder, NoteUser
+from bot.services.repository_lock import RepositoryLocker, RepositoryLockTimeout
+from bot.services.tracing import tracer
+
+
+class GitError(Exception):
+    def __init__(self, args, returncode, stderr):
+        self.args_ = args
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(f"git {args[0]} failed with code {returncode}: {stderr}")
+
+
+class MirrorRemoved(Exception):
+    """mirror was evicted from the cache while waiting for its lock"""
+
+
+async def run_git(*args, cwd=None, env=None):
+    with tracer.span(f"git.{args[0]}"):
+        process = await asyncio.create_subprocess_exec(
+            "git",
+            *args,
+            cwd=cwd,
+            env={**os.environ, **env} if env else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise GitError(args, process.returncode, stderr.decode().strip())
+    return stdout.decode().strip()
+
+
+class GitMirror(object):
+    """shallow working copy of a single notes branch"""
+
+    COMMITTER_NAME = "telenote"
+    COMMITTER_EMAIL = "telenote@users.noreply.github.com"
+    # remote commit the local commits are based on
+    BASE_REF = "refs/telenote/base"
+
+    def __init__(
+        self,
+        path: Path,
+        remote_url: str,
+        branch: str,
+        repository: str = None,
+        locker: RepositoryLocker = None,
+    ):
+        self.path = path
+        self.remote_url = remote_url
+        self.branch = branch
+        self.repository = repository
+        self.locker = locker
+        self.lock = asyncio.Lock()
+        self.removed = False
+        # local commit shas replaced by the rebase of the last push
+        self.rebased = {}
+        # a working copy left on disk by a previous run may hold unpushed
+        # commits, so it is always pushed at least once
+        self.pending = 1 if self.is_cloned else 0
+
+    @property
+    def is_cloned(self):
+        return (self.path / ".git").exists()
+
+    async def git(self, *args):
+        return await run_git(*args, cwd=self.path)
+
+    async def ensure_cloned(self):
+        if self.is_cloned:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        await run_git(
+            "clone",
+            "--quiet",
+            "--depth",
+            "1",
+            "--single-branch",
+            "--branch",
+            self.branch,
+            self.remote_url,
+            str(self.path),
+        )
+        # credentials live in the remote url, keep them out of .git/config
+        await self.git("remote", "remove", "origin")
+        await self.git("config", "user.name", self.COMMITTER_NAME)
+        await self.git("config", "user.email", self.COMMITTER_EMAIL)
+        await self.git("update-ref", self.BASE_REF, "HEAD")
+
+    async def get_upstream(self):
+        try:
+            return await self.git("rev-parse", "--verify", "--quiet", self.BASE_REF)
+        except GitError:
+            # working copy cloned before the base was recorded
+            return None
+
+    def get_file(self, file_path):
+        """file of the working tree, paths outside of it are rejected"""
+
+        root = self.path.resolve()
+        file = (root / file_path.lstrip("/")).resolve()
+        if not file.is_relative_to(root) or file.is_relative_to(root / ".git"):
+            raise ValueError(f"{file_path!r} is outside of the working tree")
+        return file
+
+    def write_changes(self, appends, files):
+        changed_paths = []
+
+        for file_path, content in appends.items():
+            file = self.get_file(file_path)
+            prev_content = file.read_text("utf-8") if file.exists() else ""
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(
+                NoteAdder.APPEND_FORMAT.format(prev=prev_content, new=content),
+                "utf-8",
+            )
+            changed_paths.append(str(file))
+
+        for file_path, content in files.items():
+            file = self.get_file(file_path)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_bytes(content)
+            changed_paths.append(str(file))
+
+        return changed_paths
+
+    async def write_stream(self, file_path, stream: MediaStream):
+        file = self.get_file(file_path)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(file, "wb") as output:
+            async for chunk in stream:
+                output.write(chunk)
+        return str(file)
+
+    async def commit(self, appends: dict, files: dict, message: str):
+        streams = {
+            file_path: content
+            for file_path, content in files.items()
+            if isinstance(content, MediaStream)
+        }
+        files = {
+            file_path: content
+            for file_path, content in files.items()
+            if file_path not in streams
+        }
+
+        # reject every path before anything is written
+        for file_path in (*appends, *files, *streams):
+            self.get_file(file_path)
+
+        async with self.lock:
+            if self.removed:
+                raise MirrorRemoved(self.path)
+
+            await self.ensure_cloned()
+            try:
+                changed_paths = await asyncio.to_thread(
+                    self.write_changes, appends, files
+                )
+                for file_path, stream in streams.items():
+                    changed_paths.append(await self.write_stream(file_path, stream))
+                await self.git("add", "--", *changed_paths)
+                await self.git("commit", "--quiet", "-m", message)
+            except Exception:
+                # a half written note must not end up in the next commit
+                await self.git("reset", "--quiet", "--hard", "HEAD")
+                await self.git("clean", "--quiet", "--force", "-d")
+                raise
+            self.pending += 1
+            return await self.git("rev-parse", "HEAD")
+
+    def lock_remote(self):
+        """lock of the remote branch shared with the other bot replicas"""
+
+        if self.locker is None:
+            return nullcontext()
+        return self.locker.lock(self.repository, self.branch)
+
+    async def push(self):
+        """push every local commit at once, rebasing if the remote moved"""
+
+        async with self.lock:
+            if not self.pending or not self.is_cloned:
+                return
+
+            async with self.lock_remote():
+                await self.push_commits()
+
+    async def push_commits(self):
+        refspec = f"HEAD:refs/heads/{self.branch}"
+        self.rebased = {}
+        try:
+            await self.git("push", "--quiet", self.remote_url, refspec)
+        except GitError:
+            upstream = await self.get_upstream()
+            if upstream is None:
+                await self.git("fetch", "--quiet", self.remote_url, self.branch)
+                rebase_args = ["FETCH_HEAD"]
+            else:
+                # replay only the local commits, so it works even when
+                # the remote history was rewritten by the compaction
+                await self.git(
+                    "fetch", "--quiet", "--depth", "1", self.remote_url, self.branch
+                )
+                rebase_args = ["--onto", "FETCH_HEAD", upstream]
+            local_commits = await self.git("rev-list", f"{rebase_args[-1]}..HEAD")
+            try:
+                await self.git("rebase", "--quiet", *rebase_args)
+            except GitError:
+                await self.git("rebase", "--abort")
+                raise
+            await self.git("push", "--quiet", self.remote_url, refspec)
+
+            rebased_commits = await self.git("rev-list", "FETCH_HEAD..HEAD")
+            # commits already on the remote are dropped by the rebase, the
+            # rest can be matched only while none were
+            if len(local_commits.split()) == len(rebased_commits.split()):
+                self.rebased = dict(zip(local_commits.split(), rebased_commits.split()))
+
+        await self.git("update-ref", self.BASE_REF, "HEAD")
+        self.pending = 0
+
+    async def remove(self):
+        """push the local commits and remove the working copy
+
+        Commits waiting for the mirror fail with MirrorRemoved afterwards,
+        so nothing is committed into a removed working copy.
+        """
+
+        async with self.lock:
+            # a working copy which could not be pushed stays on disk and is
+            # picked up by the next mirror of the same branch
+            self.removed = True
+            if self.pending and self.is_cloned:
+                async with self.lock_remote():
+                    await self.push_commits()
+            await asyncio.to_thread(shutil.rmtree, self.path, True)
+
+
+class GitMirrorCache(object):
+    """bounded on-disk cache of notes mirrors with LRU eviction"""
+
+    def __init__(
+        self,
+        root,
+        max_mirrors: int = 32,
+        push_batch_size: int = 10,
+        push_interval: float = 30,
+        locker: RepositoryLocker = None,
+    ):
+        self.root = Path(root)
+        self.max_mirrors = max_mirrors
+        self.push_batch_size = push_batch_size
+        self.push_interval = push_interval
+        self.locker = locker
+        self.mirrors: OrderedDict[str, GitMirror] = OrderedDict()
+        # keys whose working copy is being removed from disk
+        self.evicting: dict[str, asyncio.Event] = {}
+
+    @staticmethod
+    def get_key(repository, branch):
+        return f"{repository}@{branch}".replace("/", "__")
+
+    async def get(self, repository, remote_url, branch) -> GitMirror:
+        key = self.get_key(repository, branch)
+        # a new mirror would be cloned into the path being removed
+        while key in self.evicting:
+            await self.evicting[key].wait()
+
+        mirror = self.mirrors.get(key)
+        if mirror is not None:
+            mirror.remote_url = remote_url
+            self.mirrors.move_to_end(key)
+            return mirror
+
+        mirror = GitMirror(
+            self.root / key, remote_url, branch, repository, locker=self.locker
+        )
+        self.mirrors[key] = mirror
+        while len(self.mirrors) > self.max_mirrors:
+            await self.evict(next(iter(self.mirrors)))
+
+        return mirror
+
+    async def evict(self, key):
+        mirror = self.mirrors.pop(key)
+        evicted = self.evicting[key] = asyncio.Event()
+        try:
+            await mirror.remove()
+        except (GitError, RepositoryLockTimeout):
+            logging.exception("Can not push evicted mirror %s, keep it on disk", key)
+        finally:
+            del self.evicting[key]
+            evicted.set()
+
+    async def push_all(self):
+        for key, mirror in list(self.mirrors.items()):
+            try:
+                await mirror.push()
+            except (GitError, RepositoryLockTimeout):
+                logging.exception("Can not push mirror %s", key)
+
+    async def run_pusher(self):
+        while True:
+            await asyncio.sleep(self.push_interval)
+            await self.push_all()
+
+
+class MirrorNoteStorage(object):
+    """commits notes into local clones and pushes them in batches"""
+
+    def __init__(self, cache: GitMirrorCache):
+        self.cache = cache
+        self.pusher = None
+
+    async def commit(
+        self,
+        note_user: NoteUser,
+        appends: dict = None,
+        files: dict = None,
+        message: str = "Append data",
+    ):
+        if self.pusher is None:
+            # fresh context, so background pushes are not traced as this update
+            self.pusher = asyncio.create_task(
+                self.cache.run_pusher(), context=contextvars.Context()
+            )
+
+        while True:
+            mirror = await self.cache.get(
+                note_user.repository, note_user.remote_url, note_user.branch
+            )
+            try:
+                sha = await mirror.commit(appends or {}, files or {}, message)
+                break
+            except MirrorRemoved:
+                continue
+
+        if mirror.pending >= self.cache.push_batch_size:
+            try:
+                await mirror.push()
+            except RepositoryLockTimeout:
+                # the note is committed locally, the pusher retries later
+                logging.warning("Repository %s is busy, push later", mirror.path)
+            # the sha the note has on the remote
+            sha = mirror.rebased.get(sha, sha)
+
+        return sha
+
+    async def close(self):
+        if self.pusher is not None:
+            self.pusher.cancel()
+        await self.cache.push_all()
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import tempfile
+from base64 import b64encode
+
+import aiohttp
+
+from bot.services.media_stream import MediaStream
+from bot.services.note_appender import NoteAdder, NoteUser
+from bot.services.tracing import tracer
+
+
+class GraphQLError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(error.get("message", "") for error in errors))
+
+    @property
+    def is_stale_head(self):
+        return any(
+            error.get("type") == "STALE_DATA"
+            or "Expected branch to point to" in error.get("message", "")
+            for error in self.errors
+        )
+
+
+class GithubGraphQL(object):
+    DEFAULT_ENDPOINT = "https://api.github.com/graphql"
+
+    def __init__(self, endpoint: str = DEFAULT_ENDPOINT):
+        self.endpoint = endpoint
+        self.session = None
+
+    ATTACHMENT_PLACEHOLDER = "__telenote_attachment_{index}__"
+    ATTACHMENT_CHUNK_SIZE = 65536
+
+    @classmethod
+    async def stream_body(cls, body: bytes, attachments: list):
+        """request body with placeholders replaced by spooled file contents"""
+
+        for index, attachment in enumerate(attachments):
+            placeholder = cls.ATTACHMENT_PLACEHOLDER.format(index=index).encode()
+            head, body = body.split(placeholder, 1)
+            yield head
+
+            attachment.seek(0)
+            while chunk := await asyncio.to_thread(
+                attachment.read, cls.ATTACHMENT_CHUNK_SIZE
+            ):
+                yield chunk
+        yield body
+
+    async def execute(self, token, query, variables=None, attachments=None):
+        """run graphql request
+
+        ``attachments`` are files with string values too large to be kept in
+        memory, variables refer to them with ``ATTACHMENT_PLACEHOLDER``.
+        """
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        body = json.dumps({"query": query, "variables": variables or {}}).encode()
+        if attachments:
+            data = self.stream_body(body, attachments)
+        else:
+            data = body
+
+        operation = "mutation" if query.lstrip().startswith("mutation") else "query"
+        with tracer.span(f"github.graphql.{operation}"):
+            async with self.session.post(
+                self.endpoint,
+                data=data,
+                headers={
+                    "Authorization": f"bearer {token}",
+                    "Content-Type": "application/json",
+                },
+            ) as response:
+                response.raise_for_status()
+                payload = await response.json()
+
+        if payload.get("errors"):
+            raise GraphQLError(payload["errors"])
+        return payload["data"]
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class GraphQLNoteStorage(object):
+    """commits notes with a single createCommitOnBranch mutation
+
+    Every commit costs two round trips: one query for the branch head
+    (and the current content of appended files) and one mutation.
+    """
+
+    COMMIT_MUTATION = """
+    mutation($input: CreateCommitOnBranchInput!) {
+      createCommitOnBranch(input: $input) {
+        commit { oid }
+      }
+    }
+    """
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, client: GithubGraphQL):
+        self.client = client
+
+    @staticmethod
+    def build_head_query(paths_count):
+        files_variables = "".join(
+            f", $expression{index}: String!" for index in range(paths_count)
+        )
+        files_fields = "".join(
+            f"file{index}: object(expression: $expression{index})"
+            " { ... on Blob { text isTruncated } } "
+            for index in range(paths_count)
+        )
+        return (
+            "query($owner: String!, $name: String!, $ref: String!"
+            f"{files_variables}) {{"
+            " repository(owner: $owner, name: $name) {"
+            " ref(qualifiedName: $ref) { target { oid } } "
+            f"{files_fields}"
+            "} }"
+        )
+
+    async def get_head(self, note_user: NoteUser, paths):
+        """branch head oid and current text of every path at that head"""
+
+        owner, name = note_user.repository.split("/", 1)
+        variables = {
+            "owner": owner,
+            "name": name,
+            "ref": f"refs/heads/{note_user.branch}",
+        }
+        for index, file_path in enumerate(paths):
+            variables[f"expression{index}"] = f"{note_user.branch}:{file_path}"
+
+        data = await self.client.execute(
+            note_user.github_token, self.build_head_query(len(paths)), variables
+        )
+        repository = data["repository"]
+        if repository["ref"] is None:
+            raise GraphQLError(
+                [{"message": f"Branch {note_user.branch} does not exist"}]
+            )
+
+        contents = {}
+        for index, file_path in enumerate(paths):
+            blob = repository[f"file{index}"]
+            if blob is not None and blob["isTruncated"]:
+                raise GraphQLError([{"message": f"{file_path} is too large"}])
+            contents[file_path] = blob["text"] if blob is not None else ""
+
+        return repository["ref"]["target"]["oid"], contents
+
+    async def commit(
+        self,
+        note_user: NoteUser,
+        appends: dict = None,
+        files: dict = None,
+        message: str = "Append data",
+    ):
+        appends = {path.lstrip("/"): value for path, value in (appends or {}).items()}
+        files = {path.lstrip("/"): value for path, value in (files or {}).items()}
+
+        files_additions = []
+        attachments = []
+        for file_path, content in files.items():
+            if isinstance(content, MediaStream):
+                # spooled to disk, so the mutation can be retried
+                attachments.append(await self.spool(content))
+                contents = GithubGraphQL.ATTACHMENT_PLACEHOLDER.format(
+                    index=len(attachments) - 1
+                )
+            else:
+                contents = b64encode(content).decode("ascii")
+            files_additions.append({"path": file_path, "contents": contents})
+
+        try:
+            return await self.commit_additions(
+                note_user, appends, files_additions, attachments, message
+            )
+        finally:
+            for attachment in attachments:
+                attachment.close()
+
+    @staticmethod
+    async def spool(stream: MediaStream):
+        attachment = tempfile.TemporaryFile()
+        async for chunk in stream.base64_chunks():
+            attachment.write(chunk)
+        return attachment
+
+    async def commit_additions(
+        self, note_user, appends, files_additions, attachments, message
+    ):
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            head_oid, prev_contents = await self.get_head(note_user, list(appends))
+            additions = [
+                {
+                    "path": file_path,
+                    "contents": b64encode(
+                        NoteAdder.APPEND_FORMAT.format(
+                            prev=prev_contents[file_path], new=content
+                        ).encode("utf-8")
+                    ).decode("ascii"),
+                }
+                for file_path, content in appends.items()
+            ]
+
+            headline, _, body = message.partition("\n\n")
+            commit_message = {"headline": headline}
+            if body:
+                commit_message["body"] = body
+            commit_input = {
+                "branch": {
+                    "repositoryNameWithOwner": note_user.repository,
+                    "branchName": note_user.branch,
+                },
+                "message": commit_message,
+                "expectedHeadOid": head_oid,
+                "fileChanges": {"additions": [*additions, *files_additions]},
+            }
+            try:
+                data = await self.client.execute(
+                    note_user.github_token,
+                    self.COMMIT_MUTATION,
+                    {"input": commit_input},
+                    attachments=attachments,
+                )
+            except GraphQLError as error:
+                # someone else moved the branch between query and mutation
+                if error.is_stale_head and attempt < self.MAX_ATTEMPTS:
+                    continue
+                raise
+
+            return data["createCommitOnBranch"]["commit"]["oid"]
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,287 @@
+import asyncio
+import logging
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from pathlib import Path
+
+from aiogram import Bot
+from sqlalchemy import select
+
+from bot.db.models import User
+from bot.services.git_mirror import run_git
+from bot.services.metrics import metrics
+from bot.services.note_appender import NoteUser
+from bot.services.repository_lock import RepositoryLocker
+
+compacted_commits = metrics.counter(
+    "history_compacted_commits_total", "Bot commits removed by history compaction"
+)
+
+# messages of commits made by the bot, see NoteUser, BufferedNoteStorage
+# and ChatImporter
+BOT_MESSAGE = re.compile(
+    r"Append data"
+    r"|Append \d+ notes"
+    r"|Upload photo from telegram: .*"
+    r"|Import \d+ notes from telegram(\s+Telegram-[\w-]+: \d+)*"
+    r"|Compact \d+ commits of \d{4}-\d{2}-\d{2}"
+)
+LOG_FORMAT = "%x1f".join(
+    ["%H", "%P", "%T", "%an", "%ae", "%ad", "%cn", "%ce", "%cd", "%B"]
+)
+
+
+class HistoryCommit(object):
+    def __init__(self, line):
+        (
+            self.sha,
+            parents,
+            self.tree,
+            self.author_name,
+            self.author_email,
+            self.author_date,
+            self.committer_name,
+            self.committer_email,
+            self.committer_date,
+            self.message,
+        ) = line.split("\x1f")
+        self.parents = parents.split()
+        self.message = self.message.strip()
+        self.committed_at = datetime.fromtimestamp(
+            int(self.committer_date.split()[0]), timezone.utc
+        )
+
+    @property
+    def is_bot_owned(self):
+        return len(self.parents) <= 1 and bool(BOT_MESSAGE.fullmatch(self.message))
+
+    @property
+    def env(self):
+        return {
+            "GIT_AUTHOR_NAME": self.author_name,
+            "GIT_AUTHOR_EMAIL": self.author_email,
+            "GIT_AUTHOR_DATE": self.author_date,
+            "GIT_COMMITTER_NAME": self.committer_name,
+            "GIT_COMMITTER_EMAIL": self.committer_email,
+            "GIT_COMMITTER_DATE": self.committer_date,
+        }
+
+
+class CompactionResult(object):
+    def __init__(self, commits_before=0, commits_after=0, size_before=0, size_after=0):
+        self.commits_before = commits_before
+        self.commits_after = commits_after
+        self.size_before = size_before
+        self.size_after = size_after
+
+    @property
+    def commits_saved(self):
+        return self.commits_before - self.commits_after
+
+    @property
+    def bytes_saved(self):
+        return self.size_before - self.size_after
+
+
+class HistoryCompaction(object):
+    """squashes old bot commits of a notes branch into one commit per day
+
+    Only the bot owned end of the first parent history is rewritten, so
+    commits made by people are never touched, and the rewrite is pushed
+    only if the branch still points to the commit it was based on.
+    """
+
+    def __init__(self, path: Path, note_user: NoteUser, locker=None):
+        self.path = path
+        self.note_user = note_user
+        self.locker = locker
+
+    async def git(self, *args, env=None):
+        return await run_git(*args, cwd=self.path, env=env)
+
+    async def get_size(self, tip):
+        """bytes on disk of the objects reachable from the commit"""
+
+        return int(await self.git("rev-list", "--objects", "--disk-usage", tip))
+
+    async def get_bot_commits(self):
+        """bot owned commits at the end of the history, oldest first"""
+
+        output = await self.git(
+            "log",
+            "--first-parent",
+            "--date=raw",
+            f"--format={LOG_FORMAT}%x1e",
+            self.note_user.branch,
+        )
+        commits = []
+        for line in output.split("\x1e"):
+            if not line.strip():
+                continue
+            commit = HistoryCommit(line.strip("\n"))
+            if not commit.is_bot_owned:
+                break
+            commits.append(commit)
+        return commits[::-1]
+
+    async def commit_tree(self, commit: HistoryCommit, parent, message):
+        parent_args = ["-p", parent] if parent else []
+        return await self.git(
+            "commit-tree", commit.tree, *parent_args, "-m", message, env=commit.env
+        )
+
+    async def rewrite(self, commits, older_than: datetime):
+        """new tip and number of commits after the rewrite"""
+
+        parent = commits[0].parents[0] if commits[0].parents else None
+        old = []
+        for commit in commits:
+            if commit.committed_at >= older_than:
+                break
+            old.append(commit)
+        young = commits[len(old) :]
+
+        new_commits = 0
+        rewritten = False
+        for day, day_commits in groupby(old, lambda c: c.committed_at.date()):
+            day_commits = list(day_commits)
+            last = day_commits[-1]
+            if len(day_commits) == 1 and not rewritten:
+                parent = last.sha
+            else:
+                message = last.message
+                if len(day_commits) > 1:
+                    message = f"Compact {len(day_commits)} commits of {day}"
+                parent = await self.commit_tree(last, parent, message)
+                rewritten = True
+            new_commits += 1
+
+        if not rewritten:
+            return None, len(commits)
+
+        for commit in young:
+            parent = await self.commit_tree(commit, parent, commit.message)
+        return parent, new_commits + len(young)
+
+    async def push(self, new_tip, old_tip):
+        refspec = f"{new_tip}:refs/heads/{self.note_user.branch}"
+        lease = f"--force-with-lease=refs/heads/{self.note_user.branch}:{old_tip}"
+        await self.git("push", "--quiet", lease, self.note_user.remote_url, refspec)
+
+    async def __call__(self, older_than: datetime) -> CompactionResult:
+        branch = self.note_user.branch
+        await run_git(
+            "clone",
+            "--quiet",
+            "--bare",
+            "--single-branch",
+            "--branch",
+            branch,
+            self.note_user.remote_url,
+            str(self.path),
+        )
+        # credentials live in the remote url, keep them out of the config
+        await self.git("remote", "remove", "origin")
+
+        commits = await self.get_bot_commits()
+        if not commits:
+            return CompactionResult()
+
+        old_tip = commits[-1].sha
+        size_before = await self.get_size(old_tip)
+        new_tip, commits_after = await self.rewrite(commits, older_than)
+        if new_tip is None:
+            return CompactionResult(len(commits), len(commits))
+
+        # the clone is packed, so are the new objects before they are measured
+        await self.git("update-ref", f"refs/heads/{branch}", new_tip)
+        await self.git("reflog", "expire", "--expire=now", "--all")
+        await self.git("gc", "--quiet", "--prune=now")
+        size_after = await self.get_size(new_tip)
+
+        if self.locker is None:
+            await self.push(new_tip, old_tip)
+        else:
+            # a note commit in flight would be rejected after the rewrite
+            async with self.locker.lock(self.note_user.repository, branch):
+                await self.push(new_tip, old_tip)
+
+        return CompactionResult(len(commits), commits_after, size_before, size_after)
+
+
+class HistoryCompactor(object):
+    """periodically compacts histories of users who turned it on"""
+
+    def __init__(
+        self,
+        sessionmaker,
+        bot: Bot,
+        locker: RepositoryLocker = None,
+        interval: float = 24 * 3600,
+        root: str = None,
+    ):
+        self.sessionmaker = sessionmaker
+        self.bot = bot
+        self.locker = locker
+        self.interval = interval
+        self.root = root
+
+    async def compact_user(self, user: User):
+        note_user = await asyncio.to_thread(NoteUser.create_from_orm, user)
+        older_than = datetime.now(timezone.utc) - timedelta(
+            days=user.compact_after_days
+        )
+
+        path = Path(await asyncio.to_thread(tempfile.mkdtemp, dir=self.root))
+        try:
+            result = await HistoryCompaction(
+                path / "repository.git", note_user, self.locker
+            )(older_than)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, path, True)
+
+        if not result.commits_saved:
+            return
+
+        compacted_commits.inc(result.commits_saved)
+        logging.info(
+            "Compacted history of %s@%s: %s -> %s commits, %s bytes saved",
+            note_user.repository,
+            note_user.branch,
+            result.commits_before,
+            result.commits_after,
+            result.bytes_saved,
+        )
+        await self.bot.send_message(
+            user.user_id,
+            f"Notes history compacted: {result.commits_before} commits "
+            f"squashed into {result.commits_after}, "
+            f"{result.bytes_saved / 1024:.1f} KiB saved.",
+        )
+
+    async def compact_all(self):
+        async with self.sessionmaker() as session:
+            res = await session.execute(
+                select(User).where(User.compact_after_days.is_not(None))
+            )
+            users = res.scalars().all()
+
+        for user in users:
+            try:
+                await self.compact_user(user)
+            except Exception:
+                # most often the branch moved on while it was compacted,
+                # the next run will try again
+                logging.exception("Can not compact history of user %s", user.user_id)
+
+    async def run(self):
+        while True:
+            started_at = time.monotonic()
+            await self.compact_all()
+            await asyncio.sleep(
+                max(0.0, self.interval - (time.monotonic() - started_at))
+            )
@@ -0,0 +1,102 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+
+@dataclass
+class ImageSettings:
+    max_side: int
+    quality: int
+    format: str
+    thumbnail_side: int = 0
+
+    class Config:
+        # format name -> (pillow encoder, file extension)
+        formats = {
+            "jpeg": ("JPEG", "jpg"),
+            "webp": ("WEBP", "webp"),
+            "avif": ("AVIF", "avif"),
+        }
+        original_format = "original"
+        fallback_format = "webp"
+
+    @classmethod
+    def create_from_orm(cls, user, defaults):
+        """user settings with empty fields taken from the config defaults"""
+
+        def get(field, default):
+            value = getattr(user, f"image_{field}", None)
+            return default if value is None else value
+
+        return cls(
+            max_side=get("max_side", defaults.max_side),
+            quality=get("quality", defaults.quality),
+            format=get("format", defaults.format),
+            thumbnail_side=get("thumbnail_side", defaults.thumbnail_side),
+        )
+
+    @property
+    def is_enabled(self):
+        return self.format != self.Config.original_format
+
+
+@dataclass
+class ProcessedImage:
+    content: bytes
+    extension: str
+    thumbnail: bytes = None
+
+
+def encode_image(image, encoder, quality):
+    if encoder == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    output = BytesIO()
+    # metadata is not copied unless passed explicitly, so exif is stripped
+    image.save(output, format=encoder, quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def process_image(data: bytes, settings: ImageSettings) -> ProcessedImage:
+    """resize and re-encode image, runs inside the worker process"""
+
+    image_format = settings.format
+    Image.init()
+    if settings.Config.formats[image_format][0] not in Image.SAVE:
+        image_format = settings.Config.fallback_format
+    encoder, extension = settings.Config.formats[image_format]
+
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((settings.max_side, settings.max_side))
+        content = encode_image(image, encoder, settings.quality)
+
+        thumbnail = None
+        if settings.thumbnail_side:
+            image.thumbnail((settings.thumbnail_side, settings.thumbnail_side))
+            thumbnail = encode_image(image, encoder, settings.quality)
+
+    return ProcessedImage(content=content, extension=extension, thumbnail=thumbnail)
+
+
+class ImagePipeline(object):
+    def __init__(self, workers: int = 2):
+        # forking the threaded bot process could copy a lock held by another
+        # thread into the worker, spawned workers start clean
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    async def process(self, data: bytes, settings: ImageSettings) -> ProcessedImage:
+        if not settings.is_enabled:
+            return ProcessedImage(content=data, extension="jpg")
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, process_image, data, settings)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,45 @@
+from sqlalchemy import desc, select, update
+
+from bot.db.models import ChatImport
+from bot.services.tracing import tracer
+from bot.services.user_dal import BaseDAL
+
+
+class ImportDAL(BaseDAL):
+    @tracer.traced("db.create_import")
+    async def create_import(self, user_id: int, **kwargs) -> ChatImport:
+        chat_import = ChatImport(
+            user_id=user_id, status="running", processed_messages=0, **kwargs
+        )
+        self.session.add(chat_import)
+        await self.session.flush()
+        return chat_import
+
+    @tracer.traced("db.get_import")
+    async def get_import(self, import_id: int) -> ChatImport:
+        return await self.session.get(ChatImport, import_id)
+
+    @tracer.traced("db.get_import_by_file")
+    async def get_import_by_file(self, user_id: int, file_unique_id: str):
+        query = select(ChatImport).where(
+            ChatImport.user_id == user_id,
+            ChatImport.file_unique_id == file_unique_id,
+        )
+        res = await self.session.execute(query)
+        return res.scalars().first()
+
+    @tracer.traced("db.get_unfinished_import")
+    async def get_unfinished_import(self, user_id: int):
+        query = (
+            select(ChatImport)
+            .where(ChatImport.user_id == user_id, ChatImport.status != "done")
+            .order_by(desc(ChatImport.updated_at))
+            .limit(1)
+        )
+        res = await self.session.execute(query)
+        return res.scalars().first()
+
+    @tracer.traced("db.update_import")
+    async def update_import(self, import_id: int, **kwargs) -> None:
+        query = update(ChatImport).where(ChatImport.id == import_id).values(kwargs)
+        await self.session.execute(query)
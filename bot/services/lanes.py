@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from aiogram.types import Update
+
+from bot.services.metrics import metrics
+
+lane_queue_depth = metrics.gauge(
+    "lane_queue_depth", "Updates waiting for a free slot in the lane"
+)
+lane_active = metrics.gauge("lane_active", "Updates being handled in the lane")
+lane_wait = metrics.histogram(
+    "lane_wait_seconds", "Time updates waited before being handled"
+)
+
+
+def classify_update(update: Update):
+    if update.callback_query is not None:
+        return "interactive"
+
+    message = update.message or update.edited_message
+    if message is None:
+        return "interactive"
+    if message.voice is not None or message.audio is not None:
+        return "voice"
+    if message.photo or message.document is not None or message.video is not None:
+        return "media"
+    return "text"
+
+
+class Lane(object):
+    def __init__(self, name, priority, limit):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.active = 0
+        self.waiters = deque()
+
+    @property
+    def has_capacity(self):
+        return self.active < self.limit
+
+
+class LaneScheduler(object):
+    """admits updates by lane with per lane limits and a shared limit
+
+    When the shared limit is reached, freed slots go to waiting updates
+    of the lane with the highest priority (lowest number) first.
+    """
+
+    def __init__(self, lanes: dict, total_limit: int):
+        self.lanes = {
+            name: Lane(name, lane.priority, lane.limit) for name, lane in lanes.items()
+        }
+        self.by_priority = sorted(self.lanes.values(), key=lambda lane: lane.priority)
+        self.total_limit = total_limit
+        self.active = 0
+
+    def start(self, lane: Lane):
+        lane.active += 1
+        self.active += 1
+        lane_active.set(lane.active, lane=lane.name)
+
+    def wake(self):
+        for lane in self.by_priority:
+            while lane.waiters and lane.has_capacity and self.active < self.total_limit:
+                waiter = lane.waiters.popleft()
+                if waiter.done():
+                    continue
+                self.start(lane)
+                waiter.set_result(None)
+            lane_queue_depth.set(len(lane.waiters), lane=lane.name)
+
+    def release(self, lane: Lane):
+        lane.active -= 1
+        self.active -= 1
+        lane_active.set(lane.active, lane=lane.name)
+        self.wake()
+
+    async def acquire(self, lane: Lane):
+        if not lane.waiters and lane.has_capacity and self.active < self.total_limit:
+            self.start(lane)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        lane.waiters.append(waiter)
+        lane_queue_depth.set(len(lane.waiters), lane=lane.name)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # slot was granted right before the cancellation
+                self.release(lane)
+            elif waiter in lane.waiters:
+                # wake() drops cancelled waiters it comes across on its own
+                lane.waiters.remove(waiter)
+                lane_queue_depth.set(len(lane.waiters), lane=lane.name)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, lane_name):
+        lane = self.lanes[lane_name]
+        waiting_since = time.monotonic()
+        await self.acquire(lane)
+        lane_wait.observe(time.monotonic() - waiting_since, lane=lane_name)
+        try:
+            yield
+        finally:
+            self.release(lane)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from bot.services.metrics import metrics
+
+loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "Delay of event loop heartbeats over their schedule"
+)
+loop_stalls = metrics.counter(
+    "event_loop_stalls_total", "Callbacks that blocked the event loop too long"
+)
+
+
+class LoopWatchdog(object):
+    """detects callbacks blocking the event loop
+
+    A heartbeat coroutine marks the loop alive every ``interval`` seconds
+    and a helper thread checks the mark. When the loop was not seen alive
+    for longer than ``threshold`` the stack of the loop thread is captured
+    while it is still blocked.
+    """
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.reported_beat = None
+        # task -> (handler name, user id) of updates currently being handled
+        self.running = {}
+
+    def track(self, task, handler_name, user_id):
+        self.running[task] = (handler_name, user_id)
+
+    def untrack(self, task):
+        self.running.pop(task, None)
+
+    def report_stall(self, beat, blocked_for):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+
+        stack = "".join(traceback.format_stack(frame))
+        task = asyncio.current_task(self.loop)
+        handler_name, user_id = self.running.get(task, ("unknown", None))
+
+        self.reported_beat = beat
+        loop_stalls.inc(handler=handler_name)
+        logging.warning(
+            "Event loop blocked for %.3fs in handler %s (user %s), stack:\n%s",
+            blocked_for,
+            handler_name,
+            user_id,
+            stack,
+        )
+
+    def watch(self):
+        while self.loop is not None and not self.loop.is_closed():
+            time.sleep(self.interval)
+            beat = self.last_beat
+            blocked_for = time.monotonic() - beat
+            if blocked_for > self.threshold and self.reported_beat != beat:
+                self.report_stall(beat, blocked_for)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+
+        try:
+            while True:
+                scheduled_at = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.last_beat = time.monotonic()
+                loop_lag.observe(
+                    max(0.0, self.last_beat - scheduled_at - self.interval)
+                )
+        finally:
+            self.loop = None
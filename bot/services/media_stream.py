@@ -0,0 +1,87 @@
+import asyncio
+from base64 import b64encode
+from contextlib import asynccontextmanager
+
+from aiogram import Bot
+
+from bot.services.metrics import metrics
+
+media_bytes_in_flight = metrics.gauge(
+    "media_bytes_in_flight", "Bytes reserved by media uploads in progress"
+)
+media_budget_wait = metrics.histogram(
+    "media_budget_wait_seconds", "Time uploads waited for the media byte budget"
+)
+
+
+class MediaStream(object):
+    """file content which is read chunk by chunk only once"""
+
+    def __init__(self, chunks, size: int = None):
+        self.chunks = chunks
+        self.size = size
+
+    def __aiter__(self):
+        return self.chunks.__aiter__()
+
+    @classmethod
+    def from_telegram(cls, bot: Bot, file_path: str, size=None, chunk_size=65536):
+        async def chunks():
+            if bot.session.api.is_local:
+                local_path = bot.session.api.wrap_local_file.to_local(file_path)
+                with open(local_path, "rb") as file:
+                    while chunk := await asyncio.to_thread(file.read, chunk_size):
+                        yield chunk
+                return
+
+            url = bot.session.api.file_url(bot.token, file_path)
+            async for chunk in bot.session.stream_content(
+                url=url, chunk_size=chunk_size, raise_for_status=True
+            ):
+                yield chunk
+
+        return cls(chunks(), size)
+
+    async def base64_chunks(self):
+        """base64 of the stream, every chunk is encoded as soon as it arrives"""
+
+        rest = b""
+        async for chunk in self:
+            chunk = rest + chunk
+            # base64 works on groups of 3 bytes, keep the tail for the next chunk
+            cut = len(chunk) - len(chunk) % 3
+            rest = chunk[cut:]
+            if cut:
+                yield b64encode(chunk[:cut])
+        if rest:
+            yield b64encode(rest)
+
+
+class ByteBudget(object):
+    """limits the total size of media held by uploads in flight"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        # a file larger than the whole budget waits until it runs alone
+        size = min(size or 0, self.limit)
+        loop = asyncio.get_running_loop()
+        waiting_since = loop.time()
+
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+            media_bytes_in_flight.set(self.used)
+        media_budget_wait.observe(loop.time() - waiting_since)
+
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.used -= size
+                media_bytes_in_flight.set(self.used)
+                self.condition.notify_all()
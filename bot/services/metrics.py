@@ -0,0 +1,140 @@
+import threading
+from bisect import bisect_left
+
+from aiohttp import web
+
+
+class Metric(object):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def format_labels(key, **extra):
+        labels = [*key, *extra.items()]
+        if not labels:
+            return ""
+        formatted = ",".join(f'{name}="{value}"' for name, value in labels)
+        return f"{{{formatted}}}"
+
+    def render_samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{self.format_labels(key)} {value}"
+
+    def render(self):
+        with self.lock:
+            return "\n".join(
+                [
+                    f"# HELP {self.name} {self.documentation}",
+                    f"# TYPE {self.name} {self.type}",
+                    *self.render_samples(),
+                ]
+            )
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.get_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0,
+                    "count": 0,
+                }
+            histogram = self.values[key]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render_samples(self):
+        for key, histogram in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                cumulative += count
+                labels = self.format_labels(key, le=bound)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = self.format_labels(key, le="+Inf")
+            yield f"{self.name}_bucket{labels} {histogram['count']}"
+            yield f"{self.name}_sum{self.format_labels(key)} {histogram['sum']}"
+            yield f"{self.name}_count{self.format_labels(key)} {histogram['count']}"
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric_cls, name, documentation, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = metric_cls(name, documentation, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name, documentation) -> Counter:
+        return self.register(Counter, name, documentation)
+
+    def gauge(self, name, documentation) -> Gauge:
+        return self.register(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, **kwargs) -> Histogram:
+        return self.register(Histogram, name, documentation, **kwargs)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+    async def start_server(self, host: str, port: int):
+        """serve metrics in the prometheus text format on /metrics"""
+
+        async def handle_metrics(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+metrics = MetricsRegistry()
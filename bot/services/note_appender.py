@@ -1,28 +1,50 @@
+from base64 import b64encode
 from io import BytesIO
-from pathlib import Path
+import json
+import re
+from pathlib import Path, PurePosixPath
 from datetime import datetime
+import aiohttp
 import github
 from github.ContentFile import ContentFile
 from github.Repository import Repository
 
 from bot.db.models import User
+from bot.services.media_stream import MediaStream
+from bot.services.tracing import tracer
 
 
 class NoteUser(object):
-    def __init__(self, github_token, notes_repository, notes_branch, note_path=None):
+    TAG_PATTERN = re.compile(r"#[\w-]+")
+
+    def __init__(
+        self,
+        github_token,
+        notes_repository,
+        notes_branch,
+        note_path=None,
+        storage=None,
+        note_routes=None,
+    ):
+        self.github_token = github_token
         self.github_repo = notes_repository
         self.note_path = note_path
+        self.note_routes = note_routes or {}
         self.branch = notes_branch
+        self.storage = storage or RestNoteStorage()
         self.github = github.Github(github_token)
-        self.github_username = self.github.get_user().login
+        with tracer.span("github.get_user"):
+            self.github_username = self.github.get_user().login
 
     @classmethod
-    def create_from_orm(cls, user: User):
+    def create_from_orm(cls, user: User, storage=None):
         return cls(
             github_token=user.github_token,
             notes_repository=user.notes_repository,
             notes_branch=user.notes_branch,
             note_path=user.note_path,
+            storage=storage,
+            note_routes=json.loads(user.note_routes) if user.note_routes else {},
         )
 
     @property
@@ -31,28 +53,67 @@ class NoteUser(object):
 
     @property
     def remote_repo(self):
-        return self.github.get_repo(self.repository)
+        with tracer.span("github.get_repo", repository=self.repository):
+            return self.github.get_repo(self.repository)
+
+    @property
+    def remote_url(self):
+        return (
+            f"https://x-access-token:{self.github_token}"
+            f"@github.com/{self.repository}.git"
+        )
+
+    @staticmethod
+    def is_valid_note_path(file_path):
+        """path of a file inside the repository working tree"""
+
+        path = PurePosixPath(file_path)
+        return (
+            bool(path.parts)
+            and not path.is_absolute()
+            and ".." not in path.parts
+            and path.parts[0] != ".git"
+        )
+
+    def get_note_path(self, note_content):
+        """file of the first routed tag in the note or the default note file"""
+
+        for tag in self.TAG_PATTERN.findall(note_content):
+            file_path = self.note_routes.get(tag.casefold())
+            if file_path is not None:
+                return file_path
+        return self.note_path
 
     async def append_note(self, note_content):
-        adder = NoteAdder(self.remote_repo, self.note_path, self.branch)
-        await adder(note_content)
+        return await self.storage.commit(
+            self, appends={self.get_note_path(note_content): note_content}
+        )
 
-    async def upload_photo(self, photo: BytesIO, assets_folder=""):
+    async def upload_photo(
+        self,
+        photo: BytesIO | MediaStream,
+        assets_folder="",
+        extension="jpg",
+        thumbnail: bytes = None,
+    ):
         time_now = datetime.now()
         formatted_time = time_now.strftime("%H_%M_%S")
-        photo_name = f"from_telegram_{formatted_time}.jpg"
-        photo_path = str(Path(assets_folder) / photo_name)
+        photo_name = f"from_telegram_{formatted_time}"
+        photo_path = str(Path(assets_folder) / f"{photo_name}.{extension}")
+
+        files = {photo_path: photo if isinstance(photo, MediaStream) else photo.read()}
+        if thumbnail is not None:
+            thumbnail_path = str(
+                Path(assets_folder) / f"{photo_name}.thumb.{extension}"
+            )
+            files[thumbnail_path] = thumbnail
 
-        created_file = self.remote_repo.create_file(
-            path=photo_path,
+        return await self.storage.commit(
+            self,
+            files=files,
             message=f"Upload photo from telegram: {formatted_time}",
-            content=photo.read(),
-            branch=self.branch,
         )
 
-        branch_refs = self.remote_repo.get_git_ref(f"heads/{self.branch}")
-        branch_refs.edit(sha=created_file["commit"].sha)
-
     async def get_contents_by_path(self, file_path=""):
         return self.remote_repo.get_contents(file_path, ref=self.branch)
 
@@ -70,25 +131,40 @@ class NoteAdder(object):
         elements,
         commit_message: str = "Append data",
     ):
-        branch_sha = self.remote_repo.get_branch(self.branch).commit.sha
-        base_tree = self.remote_repo.get_git_tree(sha=branch_sha)
-        tree = self.remote_repo.create_git_tree(elements, base_tree)
-        parent = self.remote_repo.get_git_commit(sha=branch_sha)
-        commit = self.remote_repo.create_git_commit(commit_message, tree, [parent])
-        branch_refs = self.remote_repo.get_git_ref(f"heads/{self.branch}")
-        branch_refs.edit(sha=commit.sha)
+        with tracer.span("github.get_branch"):
+            branch_sha = self.remote_repo.get_branch(self.branch).commit.sha
+        with tracer.span("github.get_git_tree"):
+            base_tree = self.remote_repo.get_git_tree(sha=branch_sha)
+        with tracer.span("github.create_git_tree", elements=len(elements)):
+            tree = self.remote_repo.create_git_tree(elements, base_tree)
+        with tracer.span("github.get_git_commit"):
+            parent = self.remote_repo.get_git_commit(sha=branch_sha)
+        with tracer.span("github.create_git_commit"):
+            commit = self.remote_repo.create_git_commit(commit_message, tree, [parent])
+        with tracer.span("github.get_git_ref"):
+            branch_refs = self.remote_repo.get_git_ref(f"heads/{self.branch}")
+        with tracer.span("github.edit_git_ref"):
+            branch_refs.edit(sha=commit.sha)
+        return commit.sha
 
     def get_changes_element(self, content):
         """get changes element of file after append new content"""
 
-        prev_content_file: ContentFile = self.remote_repo.get_contents(
-            self.file_path, ref=self.branch
-        )
-        prev_content = prev_content_file.decoded_content
-        prev_content = prev_content.decode("utf-8")
+        try:
+            with tracer.span("github.get_contents", path=self.file_path):
+                prev_content_file: ContentFile = self.remote_repo.get_contents(
+                    self.file_path, ref=self.branch
+                )
+        except github.UnknownObjectException:
+            # routed notes may go to a file which does not exist yet
+            prev_content = ""
+        else:
+            prev_content = prev_content_file.decoded_content
+            prev_content = prev_content.decode("utf-8")
 
         formatted_content = self.APPEND_FORMAT.format(prev=prev_content, new=content)
-        blob = self.remote_repo.create_git_blob(formatted_content, "utf-8")
+        with tracer.span("github.create_git_blob", size=len(formatted_content)):
+            blob = self.remote_repo.create_git_blob(formatted_content, "utf-8")
 
         element = github.InputGitTreeElement(
             path=self.file_path, mode="100644", type="blob", sha=blob.sha
@@ -98,7 +174,95 @@ class NoteAdder(object):
 
     async def append_data(self, content):
         element = self.get_changes_element(content)
-        self.commit_and_push_elements([element])
+        return self.commit_and_push_elements([element])
 
     async def __call__(self, content):
-        await self.append_data(content)
+        return await self.append_data(content)
+
+
+class RestNoteStorage(object):
+    """commits notes through the github REST api, one commit per call"""
+
+    GITHUB_API_URL = "https://api.github.com"
+
+    def __init__(self, api_url: str = GITHUB_API_URL):
+        self.api_url = api_url
+        self.session = None
+
+    async def create_blob_stream(self, note_user: NoteUser, stream: MediaStream):
+        """create blob sending base64 of the stream while it is downloaded"""
+
+        async def body():
+            yield b'{"encoding": "base64", "content": "'
+            async for chunk in stream.base64_chunks():
+                yield chunk
+            yield b'"}'
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        with tracer.span("github.create_git_blob", size=stream.size, streamed=True):
+            async with self.session.post(
+                f"{self.api_url}/repos/{note_user.repository}/git/blobs",
+                data=body(),
+                headers={
+                    "Authorization": f"token {note_user.github_token}",
+                    "Accept": "application/vnd.github+json",
+                    "Content-Type": "application/json",
+                },
+            ) as response:
+                response.raise_for_status()
+                return (await response.json())["sha"]
+
+    async def commit(
+        self,
+        note_user: NoteUser,
+        appends: dict = None,
+        files: dict = None,
+        message: str = "Append data",
+    ):
+        appends = appends or {}
+        files = files or {}
+        remote_repo = note_user.remote_repo
+
+        has_streams = any(
+            isinstance(content, MediaStream) for content in files.values()
+        )
+        if not appends and len(files) == 1 and not has_streams:
+            # contents api creates the commit in a single request
+            [(file_path, content)] = files.items()
+            with tracer.span("github.create_file", size=len(content)):
+                created_file = remote_repo.create_file(
+                    path=file_path,
+                    message=message,
+                    content=content,
+                    branch=note_user.branch,
+                )
+            return created_file["commit"].sha
+
+        elements = [
+            NoteAdder(remote_repo, file_path, note_user.branch).get_changes_element(
+                content
+            )
+            for file_path, content in appends.items()
+        ]
+        for file_path, content in files.items():
+            if isinstance(content, MediaStream):
+                blob_sha = await self.create_blob_stream(note_user, content)
+            else:
+                with tracer.span("github.create_git_blob", size=len(content)):
+                    blob_sha = remote_repo.create_git_blob(
+                        b64encode(content).decode("ascii"), "base64"
+                    ).sha
+            elements.append(
+                github.InputGitTreeElement(
+                    path=file_path, mode="100644", type="blob", sha=blob_sha
+                )
+            )
+
+        adder = NoteAdder(remote_repo, note_user.note_path, note_user.branch)
+        return adder.commit_and_push_elements(elements, message)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
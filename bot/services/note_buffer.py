@@ -0,0 +1,104 @@
+import asyncio
+from collections import defaultdict
+
+from bot.services.note_appender import NoteUser
+
+
+class PendingCommit(object):
+    def __init__(self, note_user: NoteUser):
+        self.note_user = note_user
+        self.appends = defaultdict(list)
+        self.waiters = []
+        self.flusher = None
+
+    @property
+    def notes_count(self):
+        return len(self.waiters)
+
+
+class BufferedNoteStorage(object):
+    """collects appended notes for a short delay and commits them at once
+
+    Notes for every target file of the same repository branch end up in a
+    single commit. Commits with files or a message of their own, like chat
+    import batches, are passed through immediately.
+    """
+
+    DEFAULT_MESSAGE = "Append data"
+
+    def __init__(self, storage, delay: float = 1.0, max_notes: int = 50):
+        self.storage = storage
+        self.delay = delay
+        self.max_notes = max_notes
+        self.pending = {}
+        self.flushes = set()
+
+    async def commit(
+        self,
+        note_user: NoteUser,
+        appends: dict = None,
+        files: dict = None,
+        message: str = DEFAULT_MESSAGE,
+    ):
+        if files or not appends or message != self.DEFAULT_MESSAGE:
+            return await self.storage.commit(
+                note_user, appends=appends, files=files, message=message
+            )
+
+        key = (note_user.repository, note_user.branch)
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = PendingCommit(note_user)
+            pending.flusher = asyncio.create_task(self.flush_later(key, pending))
+
+        for file_path, content in appends.items():
+            pending.appends[file_path].append(content)
+        waiter = asyncio.get_running_loop().create_future()
+        pending.waiters.append(waiter)
+
+        if pending.notes_count >= self.max_notes:
+            del self.pending[key]
+            pending.flusher.cancel()
+            pending.flusher = asyncio.create_task(self.flush(key, pending))
+            self.flushes.add(pending.flusher)
+            pending.flusher.add_done_callback(self.flushes.discard)
+
+        return await waiter
+
+    async def flush_later(self, key, pending: PendingCommit):
+        await asyncio.sleep(self.delay)
+        await self.flush(key, pending)
+
+    async def flush(self, key, pending: PendingCommit):
+        if self.pending.get(key) is pending:
+            del self.pending[key]
+
+        appends = {
+            file_path: "\n".join(contents)
+            for file_path, contents in pending.appends.items()
+        }
+        message = self.DEFAULT_MESSAGE
+        if pending.notes_count > 1:
+            message = f"Append {pending.notes_count} notes"
+
+        try:
+            sha = await self.storage.commit(
+                pending.note_user, appends=appends, message=message
+            )
+        except Exception as error:
+            for waiter in pending.waiters:
+                if not waiter.done():
+                    waiter.set_exception(error)
+            return
+
+        for waiter in pending.waiters:
+            if not waiter.done():
+                waiter.set_result(sha)
+
+    async def close(self):
+        for key, pending in list(self.pending.items()):
+            pending.flusher.cancel()
+            await self.flush(key, pending)
+        # batches flushed early for reaching max_notes may still be committing
+        await asyncio.gather(*self.flushes)
+        await self.storage.close()
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from sqlalchemy import desc, func, insert, select
+
+from bot.db.models import NoteIndexEntry
+from bot.services.tracing import tracer
+from bot.services.user_dal import BaseDAL
+
+
+class NoteIndexDAL(BaseDAL):
+    TS_CONFIG = "simple"
+
+    @tracer.traced("db.index_note")
+    async def add_note(
+        self,
+        user_id: int,
+        content: str,
+        commit_sha: str = None,
+        note_path: str = None,
+        created_at: datetime = None,
+        transcription_model: str = None,
+    ) -> None:
+        entry = NoteIndexEntry(
+            user_id=user_id,
+            content=content,
+            commit_sha=commit_sha,
+            note_path=note_path,
+            transcription_model=transcription_model,
+        )
+        if created_at is not None:
+            entry.created_at = created_at
+        self.session.add(entry)
+        await self.session.flush()
+
+    @tracer.traced("db.index_notes")
+    async def add_notes(self, rows: list[dict]) -> None:
+        if rows:
+            await self.session.execute(insert(NoteIndexEntry), rows)
+
+    @tracer.traced("db.indexed_contents")
+    async def get_contents(self, user_id: int, note_path: str):
+        res = await self.session.execute(
+            select(NoteIndexEntry.content)
+            .where(NoteIndexEntry.user_id == user_id)
+            .where(NoteIndexEntry.note_path == note_path)
+            .order_by(NoteIndexEntry.id)
+        )
+        return res.scalars().all()
+
+    @tracer.traced("db.search_notes")
+    async def search(self, user_id: int, query: str, limit: int = 10):
+        ts_query = func.websearch_to_tsquery(self.TS_CONFIG, query)
+        rank = func.ts_rank(NoteIndexEntry.content_tsv, ts_query)
+        query = (
+            select(NoteIndexEntry)
+            .where(NoteIndexEntry.user_id == user_id)
+            .where(NoteIndexEntry.content_tsv.op("@@")(ts_query))
+            .order_by(desc(rank), desc(NoteIndexEntry.created_at))
+            .limit(limit)
+        )
+        res = await self.session.execute(query)
+        return res.scalars().all()
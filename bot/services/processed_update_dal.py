@@ -0,0 +1,55 @@
+from datetime import datetime
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from bot.db.models import ProcessedUpdate
+from bot.services.tracing import tracer
+from bot.services.user_dal import BaseDAL
+
+
+class ProcessedUpdateDAL(BaseDAL):
+    @tracer.traced("db.is_update_processed")
+    async def is_processed(self, chat_id: int, message_id: int) -> bool:
+        query = select(ProcessedUpdate.chat_id).where(
+            ProcessedUpdate.chat_id == chat_id,
+            ProcessedUpdate.message_id == message_id,
+        )
+        res = await self.session.execute(query)
+        return res.first() is not None
+
+    @tracer.traced("db.get_processed_updates")
+    async def get_processed_since(self, processed_after: datetime, limit: int):
+        """(chat id, message id, processed at) of the latest processed updates"""
+        query = (
+            select(
+                ProcessedUpdate.chat_id,
+                ProcessedUpdate.message_id,
+                ProcessedUpdate.processed_at,
+            )
+            .where(ProcessedUpdate.processed_at > processed_after)
+            .order_by(ProcessedUpdate.processed_at.desc())
+            .limit(limit)
+        )
+        res = await self.session.execute(query)
+        return res.all()
+
+    @tracer.traced("db.add_processed_updates")
+    async def add_processed(self, keys: list[tuple[int, int]]) -> None:
+        if keys:
+            query = insert(ProcessedUpdate).on_conflict_do_nothing()
+            await self.session.execute(
+                query,
+                [
+                    {"chat_id": chat_id, "message_id": message_id}
+                    for chat_id, message_id in keys
+                ],
+            )
+
+    @tracer.traced("db.delete_processed_updates")
+    async def delete_older_than(self, processed_before: datetime) -> int:
+        query = delete(ProcessedUpdate).where(
+            ProcessedUpdate.processed_at < processed_before
+        )
+        res = await self.session.execute(query)
+        return res.rowcount
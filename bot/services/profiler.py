@@ -0,0 +1,63 @@
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class ProfilerBusyError(Exception):
+    ...
+
+
+class SamplingProfiler(object):
+    """samples python stacks of every thread from a helper thread
+
+    Result is in the collapsed stacks format (``frame;frame;frame count``)
+    understood by flamegraph.pl, speedscope and inferno.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def format_frame(frame):
+        code = frame.f_code
+        return f"{code.co_qualname} ({code.co_filename}:{code.co_firstlineno})"
+
+    def sample(self, counts: Counter, own_thread_id: int):
+        threads_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(self.format_frame(frame))
+                frame = frame.f_back
+            stack.append(f"thread {threads_names.get(thread_id, thread_id)}")
+            counts[";".join(reversed(stack))] += 1
+
+    def run(self, duration: float) -> Counter:
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusyError("Profiler is already running")
+
+        try:
+            counts = Counter()
+            own_thread_id = threading.get_ident()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                self.sample(counts, own_thread_id)
+                time.sleep(self.interval)
+            return counts
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def collapse(counts: Counter) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    async def profile(self, duration: float) -> str:
+        counts = await asyncio.to_thread(self.run, duration)
+        return self.collapse(counts)
@@ -0,0 +1,128 @@
+import hashlib
+import time
+from contextlib import asynccontextmanager
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from bot.services.metrics import metrics
+from bot.services.note_appender import NoteUser
+from bot.services.tracing import tracer
+
+lock_wait = metrics.histogram(
+    "repository_lock_wait_seconds", "Time spent waiting for a repository lock"
+)
+lock_timeouts = metrics.counter(
+    "repository_lock_timeouts_total", "Repository locks not acquired in time"
+)
+
+
+class RepositoryLockTimeout(Exception):
+    ...
+
+
+class RepositoryLocker(object):
+    """cluster wide lock per repository branch on postgres advisory locks
+
+    The lock is transaction scoped, so it is released together with the
+    connection even if the process holding it dies. A lock holds its
+    connection for the whole commit, so locks get an engine of their own
+    and never take connections handlers need. The pool should fit every
+    commit a process runs at once, otherwise commits wait for a connection
+    instead of the lock.
+    """
+
+    LOCK_NOT_AVAILABLE = "55P03"
+
+    def __init__(self, engine: AsyncEngine, timeout: float = 30):
+        self.engine = engine
+        self.timeout = timeout
+
+    @classmethod
+    def create(cls, db_url, timeout: float = 30, pool_size: int = 4):
+        """locker on a pool of its own
+
+        Waiting for a free connection counts against the lock timeout,
+        the lock itself is waited for only for the rest of it.
+        """
+
+        engine = create_async_engine(
+            url=db_url, pool_size=pool_size, max_overflow=0, pool_timeout=timeout
+        )
+        return cls(engine, timeout=timeout)
+
+    async def close(self):
+        await self.engine.dispose()
+
+    @staticmethod
+    def get_key(repository, branch):
+        digest = hashlib.blake2b(f"{repository}@{branch}".encode(), digest_size=8)
+        return int.from_bytes(digest.digest(), "big", signed=True)
+
+    @asynccontextmanager
+    async def lock(self, repository, branch):
+        waiting_since = time.monotonic()
+
+        try:
+            connection = await self.engine.connect()
+        except PoolTimeoutError as error:
+            lock_timeouts.inc()
+            raise RepositoryLockTimeout(
+                f"No connection for a lock of {repository}@{branch} "
+                f"in {self.timeout}s"
+            ) from error
+
+        # postgres treats a zero lock_timeout as no timeout at all
+        remaining = self.timeout - (time.monotonic() - waiting_since)
+        async with connection:
+            async with connection.begin():
+                await connection.execute(
+                    text("SELECT set_config('lock_timeout', :timeout, true)"),
+                    {"timeout": f"{max(int(remaining * 1000), 1)}ms"},
+                )
+                try:
+                    with tracer.span("db.repository_lock", repository=repository):
+                        await connection.execute(
+                            text("SELECT pg_advisory_xact_lock(:key)"),
+                            {"key": self.get_key(repository, branch)},
+                        )
+                except DBAPIError as error:
+                    sqlstate = getattr(error.orig, "sqlstate", None)
+                    if sqlstate == self.LOCK_NOT_AVAILABLE:
+                        lock_timeouts.inc()
+                        raise RepositoryLockTimeout(
+                            f"Repository {repository}@{branch} is locked "
+                            f"for more than {self.timeout}s"
+                        ) from error
+                    raise
+                lock_wait.observe(time.monotonic() - waiting_since)
+
+                yield
+
+
+class LockedNoteStorage(object):
+    """serializes commits to the same repository across all bot replicas
+
+    Commits which could not take the lock raise RepositoryLockTimeout and
+    leave the repository untouched, so the note can be sent again.
+    """
+
+    def __init__(self, storage, locker: RepositoryLocker):
+        self.storage = storage
+        self.locker = locker
+
+    async def commit(
+        self,
+        note_user: NoteUser,
+        appends: dict = None,
+        files: dict = None,
+        message: str = "Append data",
+    ):
+        async with self.locker.lock(note_user.repository, note_user.branch):
+            return await self.storage.commit(
+                note_user, appends=appends, files=files, message=message
+            )
+
+    async def close(self):
+        await self.storage.close()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import sys
+
+from github import UnknownObjectException
+from sqlalchemy import select, or_
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from bot.config import config
+from bot.db.models import User
+from bot.services.note_appender import NoteUser
+from bot.services.note_index_dal import NoteIndexDAL
+from bot.services.user_dal import UserDAL
+
+
+def split_notes(content: str, indexed: list[str] = ()):
+    """notes of a file which are not indexed yet
+
+    Notes are appended after a single newline, see NoteAdder.APPEND_FORMAT,
+    so nothing marks where a note of several lines ends. Indexed notes are
+    cut out as whole blocks of lines, from the end of the file and the
+    latest first, and the rest is split line by line.
+    """
+
+    lines = [line.rstrip() for line in content.splitlines()]
+    end = len(lines)
+    for note in reversed(indexed):
+        block = [line.rstrip() for line in note.splitlines()]
+        if not block:
+            continue
+        # the latest occurrence above the notes cut out already
+        for start in range(end - len(block), -1, -1):
+            if lines[start : start + len(block)] == block:
+                del lines[start : start + len(block)]
+                end = start
+                break
+
+    return [line.strip() for line in lines if line.strip()]
+
+
+async def backfill_file(session, user: User, remote_repo, head, note_path):
+    try:
+        content_file = await asyncio.to_thread(
+            remote_repo.get_contents, note_path, ref=head.commit.sha
+        )
+    except UnknownObjectException:
+        # routed file which got no notes yet
+        return 0
+
+    # notes saved since the deploy are indexed already, whatever their commit
+    # is after history compaction
+    dal = NoteIndexDAL(session)
+    notes = split_notes(
+        content_file.decoded_content.decode("utf-8"),
+        await dal.get_contents(user.user_id, note_path),
+    )
+
+    await dal.add_notes(
+        [
+            {
+                "user_id": user.user_id,
+                "content": note,
+                "commit_sha": head.commit.sha,
+                "note_path": note_path,
+                "created_at": head.commit.commit.committer.date,
+            }
+            for note in notes
+        ]
+    )
+    return len(notes)
+
+
+async def backfill_user(session, user: User):
+    note_user = await asyncio.to_thread(NoteUser.create_from_orm, user)
+    remote_repo = await asyncio.to_thread(lambda: note_user.remote_repo)
+    head = await asyncio.to_thread(remote_repo.get_branch, note_user.branch)
+
+    count = 0
+    note_paths = dict.fromkeys([note_user.note_path, *note_user.note_routes.values()])
+    for note_path in note_paths:
+        count += await backfill_file(session, user, remote_repo, head, note_path)
+
+    await UserDAL(session).update_user(user.user_id, notes_backfilled=True)
+    await session.commit()
+    return count
+
+
+async def backfill(sessionmaker):
+    """index note files of users which were never indexed"""
+
+    async with sessionmaker() as session:
+        res = await session.execute(
+            select(User).where(
+                or_(User.notes_backfilled.is_(None), User.notes_backfilled.is_(False))
+            )
+        )
+        users = res.scalars().all()
+
+    for user in users:
+        async with sessionmaker() as session:
+            try:
+                count = await backfill_user(session, user)
+            except Exception:
+                logging.exception("Can not backfill notes of user %s", user.user_id)
+                continue
+        logging.info("Indexed %s notes of user %s", count, user.user_id)
+
+
+async def main():
+    engine = create_async_engine(url=config.db.db_url)
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    try:
+        await backfill(sessionmaker)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(main())
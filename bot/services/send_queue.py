@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageReplyMarkup, EditMessageText
+
+from bot.services.metrics import metrics
+
+send_queue_depth = metrics.gauge(
+    "telegram_send_queue_depth", "Bot API requests waiting for a send slot"
+)
+send_latency = metrics.histogram(
+    "telegram_send_seconds", "Time from queueing a Bot API request to its response"
+)
+retry_after_hits = metrics.counter(
+    "telegram_retry_after_total", "Bot API requests rejected by flood control"
+)
+superseded_edits = metrics.counter(
+    "telegram_superseded_edits_total", "Message edits replaced by a newer edit"
+)
+
+
+class RateLimit(object):
+    """``rate`` requests per second with bursts of ``burst`` requests
+
+    Send times are handed out in the order of requests, so requests to one
+    chat keep their order.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1 / rate
+        self.burst = burst
+        # time when the bucket is empty again, see GCRA
+        self.theoretical_arrival = 0.0
+        self.blocked_until = 0.0
+
+    def reserve(self, now):
+        """time when the next request may be sent"""
+
+        self.theoretical_arrival = (
+            max(self.theoretical_arrival, now, self.blocked_until) + self.interval
+        )
+        return max(
+            now,
+            self.blocked_until,
+            self.theoretical_arrival - self.burst * self.interval,
+        )
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+        # no burst right after flood control, the bucket starts empty
+        self.theoretical_arrival = max(
+            self.theoretical_arrival, until + (self.burst - 1) * self.interval
+        )
+
+    def is_idle(self, now):
+        return self.theoretical_arrival <= now and self.blocked_until <= now
+
+
+class PendingEdit(object):
+    def __init__(self, method):
+        self.method = method
+        self.task = None
+        # delivery of an older edit which sent this one on its retry
+        self.sent_by = None
+
+
+class SendQueue(object):
+    """spaces out Bot API requests to chats within telegram limits
+
+    Requests to one chat are sent one by one in their order, each waits for
+    a slot of its chat and of the bot as a whole. A request rejected with
+    retry after blocks its chat for that time and is sent again before any
+    later request to the chat. A message edit still waiting to be sent is
+    replaced by a newer edit of the same message, and both callers get its
+    result.
+    """
+
+    EDIT_METHODS = (EditMessageText, EditMessageReplyMarkup)
+    MIN_PRUNE_SIZE = 1024
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: int = 3,
+        group_rate: float = 20 / 60,
+        max_retries: int = 3,
+    ):
+        self.global_limit = RateLimit(global_rate, burst=max(int(global_rate), 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.chat_limits = {}
+        self.prune_size = self.MIN_PRUNE_SIZE
+        # chat id -> future done when the last request to the chat is sent
+        self.chat_tails = {}
+        # (method type, chat id, message id) -> edit waiting to be sent
+        self.pending_edits = {}
+        self.waiting = 0
+
+    def get_chat_limit(self, chat_id):
+        limit = self.chat_limits.get(chat_id)
+        if limit is None:
+            if len(self.chat_limits) >= self.prune_size:
+                self.forget_idle_chats()
+            # groups, channels and @usernames have a much lower limit
+            if isinstance(chat_id, int) and chat_id > 0:
+                limit = RateLimit(self.chat_rate, burst=self.chat_burst)
+            else:
+                limit = RateLimit(self.group_rate)
+            self.chat_limits[chat_id] = limit
+        return limit
+
+    def forget_idle_chats(self):
+        """idle chats have a full burst again, the same as unknown chats"""
+
+        now = time.monotonic()
+        self.chat_limits = {
+            chat_id: limit
+            for chat_id, limit in self.chat_limits.items()
+            if not limit.is_idle(now)
+        }
+        self.prune_size = max(self.MIN_PRUNE_SIZE, len(self.chat_limits) * 2)
+
+    @asynccontextmanager
+    async def chat_turn(self, chat_id):
+        """waits until every earlier request to the chat is sent"""
+
+        previous = self.chat_tails.get(chat_id)
+        turn = asyncio.get_running_loop().create_future()
+        self.chat_tails[chat_id] = turn
+        try:
+            if previous is not None and not previous.done():
+                self.waiting += 1
+                send_queue_depth.set(self.waiting)
+                try:
+                    await asyncio.shield(previous)
+                finally:
+                    self.waiting -= 1
+                    send_queue_depth.set(self.waiting)
+            yield
+        finally:
+            if previous is None or previous.done():
+                turn.set_result(None)
+            else:
+                # cancelled while waiting, later requests still wait for earlier
+                previous.add_done_callback(lambda _: turn.set_result(None))
+            if self.chat_tails.get(chat_id) is turn:
+                del self.chat_tails[chat_id]
+
+    async def wait_slot(self, chat_id):
+        chat_limit = self.get_chat_limit(chat_id)
+        # reserved in turn, so a blocked chat spaces out the requests after it
+        send_at = chat_limit.reserve(time.monotonic())
+
+        self.waiting += 1
+        send_queue_depth.set(self.waiting)
+        try:
+            delay = send_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # the shared slot is taken only when the chat is ready to send
+            delay = self.global_limit.reserve(time.monotonic()) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+            send_queue_depth.set(self.waiting)
+
+    def take_pending_edit(self, method, key, pending: PendingEdit):
+        """the latest edit of the message to send, newer ones go on their own"""
+
+        latest = self.pending_edits.pop(key, None)
+        if latest is None:
+            return method
+        if latest is not pending:
+            # a newer edit came while this one waited for a retry
+            latest.sent_by = asyncio.current_task()
+            superseded_edits.inc(method=type(method).__name__)
+        return latest.method
+
+    async def deliver(self, make_request, bot, method, chat_id, pending=None):
+        key = None
+        if pending is not None:
+            key = (type(method), chat_id, method.message_id)
+
+        async with self.chat_turn(chat_id):
+            if pending is not None and pending.sent_by is not None:
+                return await asyncio.shield(pending.sent_by)
+
+            attempt = 0
+            while True:
+                await self.wait_slot(chat_id)
+                if key is not None:
+                    method = self.take_pending_edit(method, key, pending)
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as error:
+                    retry_after_hits.inc(method=type(method).__name__)
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        raise
+                    logging.warning(
+                        "Flood control in chat %s, retry in %ss",
+                        chat_id,
+                        error.retry_after,
+                    )
+                    self.get_chat_limit(chat_id).block(
+                        time.monotonic() + error.retry_after
+                    )
+
+    async def send(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        started_at = time.monotonic()
+        key = None
+        if isinstance(method, self.EDIT_METHODS):
+            key = (type(method), chat_id, method.message_id)
+
+        if key is None:
+            result = await self.deliver(make_request, bot, method, chat_id)
+        else:
+            pending = self.pending_edits.get(key)
+            if pending is None:
+                pending = self.pending_edits[key] = PendingEdit(method)
+                pending.task = asyncio.create_task(
+                    self.deliver(make_request, bot, method, chat_id, pending)
+                )
+                # errors are raised to the callers, do not log them twice
+                pending.task.add_done_callback(
+                    lambda task: task.cancelled() or task.exception()
+                )
+            else:
+                pending.method = method
+                superseded_edits.inc(method=type(method).__name__)
+            # the edit is sent even if this caller is cancelled
+            result = await asyncio.shield(pending.task)
+
+        send_latency.observe(
+            time.monotonic() - started_at, method=type(method).__name__
+        )
+        return result
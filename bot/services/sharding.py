@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import queue
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+
+
+def get_update_user_id(update: dict):
+    """id of the user who caused the raw update, falls back to the chat id"""
+
+    for event in update.values():
+        if not isinstance(event, dict):
+            continue
+        for key in ("from", "user"):
+            if isinstance(event.get(key), dict):
+                return event[key]["id"]
+        if isinstance(event.get("chat"), dict):
+            return event["chat"]["id"]
+        if isinstance(event.get("message"), dict):
+            return get_update_user_id({"message": event["message"]})
+
+    return None
+
+
+def get_shard(key, shards):
+    """rendezvous hashing, only keys of a missing shard move elsewhere"""
+
+    def weight(shard):
+        digest = hashlib.blake2b(f"{key}:{shard}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    return max(shards, key=weight)
+
+
+class ShardSupervisor(object):
+    """receives updates and hands them to worker processes by user id
+
+    Updates of one user go to the same worker until the worker acknowledges
+    all of them, so their order is kept even when users move between
+    workers. When a worker dies the updates it did not acknowledge are
+    handed to the remaining ones, then it is restarted.
+
+    Every worker runs a whole bot, so each of them loads every configured
+    whisper model.
+    """
+
+    def __init__(
+        self,
+        workers_count: int,
+        worker_target,
+        restart_delay: float = 1,
+        max_restart_delay: float = 60,
+        check_interval: float = 1,
+    ):
+        self.context = multiprocessing.get_context("spawn")
+        self.workers_count = workers_count
+        self.worker_target = worker_target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.check_interval = check_interval
+        self.queues = {}
+        self.acks = {}
+        self.processes = {}
+        # shard -> (monotonic time of the next allowed restart, current delay)
+        self.restarts = {}
+        # update id -> (shard, user key, update) in the order of dispatching
+        self.unacked = {}
+        # user key -> [shard, count of unacknowledged updates]
+        self.routes = {}
+        # dead shards whose updates were handed over
+        self.failed = set()
+
+    def start_worker(self, shard):
+        # a worker killed while reading could leave the old queues locked
+        self.queues[shard] = self.context.Queue()
+        self.acks[shard] = self.context.Queue()
+        process = self.context.Process(
+            target=self.worker_target,
+            args=(shard, self.queues[shard], self.acks[shard]),
+            name=f"shard-worker-{shard}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+        logging.info("Started shard worker %s (pid %s)", shard, process.pid)
+
+    def start(self):
+        for shard in range(self.workers_count):
+            self.start_worker(shard)
+
+    def receive_acks(self):
+        for shard, acks in self.acks.items():
+            while True:
+                try:
+                    update_id = acks.get_nowait()
+                except queue.Empty:
+                    break
+                self.acknowledge(shard, update_id)
+
+    def acknowledge(self, shard, update_id):
+        # updates handed over to another worker are acknowledged by that one
+        if self.unacked.get(update_id, (None,))[0] != shard:
+            return
+
+        _, key, _ = self.unacked.pop(update_id)
+        route = self.routes[key]
+        route[1] -= 1
+        if not route[1]:
+            del self.routes[key]
+
+    def reroute(self, shard):
+        """hand updates left to a shard to the live workers in their order"""
+
+        updates = [
+            (update_id, update)
+            for update_id, (update_shard, _, update) in self.unacked.items()
+            if update_shard == shard
+        ]
+        for update_id, _ in updates:
+            self.acknowledge(shard, update_id)
+        for _, update in updates:
+            self.dispatch(update)
+
+        return len(updates)
+
+    def check_workers(self):
+        self.receive_acks()
+
+        now = time.monotonic()
+        for shard, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+
+            if shard not in self.failed:
+                self.failed.add(shard)
+                logging.warning(
+                    "Shard worker %s exited with code %s, %s updates handed over",
+                    shard,
+                    process.exitcode,
+                    self.reroute(shard),
+                )
+
+            restart_at, delay = self.restarts.get(shard, (now, self.restart_delay))
+            if now < restart_at:
+                continue
+
+            logging.warning("Restarting shard worker %s", shard)
+            self.start_worker(shard)
+            self.failed.discard(shard)
+            self.restarts[shard] = (now + delay, min(delay * 2, self.max_restart_delay))
+            # updates put while no worker was alive are in the replaced queue
+            self.reroute(shard)
+
+    async def supervise(self):
+        while True:
+            self.check_workers()
+            await asyncio.sleep(self.check_interval)
+
+    @property
+    def alive_shards(self):
+        return [
+            shard for shard, process in self.processes.items() if process.is_alive()
+        ]
+
+    def dispatch(self, update: dict):
+        key = get_update_user_id(update)
+        if key is None:
+            key = update["update_id"]
+
+        route = self.routes.get(key)
+        if route is None:
+            shards = self.alive_shards or list(self.processes)
+            route = self.routes[key] = [get_shard(key, shards), 0]
+        shard = route[0]
+        route[1] += 1
+        self.unacked[update["update_id"]] = (shard, key, update)
+        self.queues[shard].put(update)
+
+    async def poll(self, bot: Bot, allowed_updates=None, polling_timeout: int = 30):
+        offset = None
+        supervisor = asyncio.create_task(self.supervise())
+        try:
+            while True:
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset,
+                        timeout=polling_timeout,
+                        allowed_updates=allowed_updates,
+                    )
+                except (TelegramNetworkError, TelegramServerError):
+                    logging.exception("Can not get updates, retrying")
+                    await asyncio.sleep(self.restart_delay)
+                    continue
+
+                self.receive_acks()
+                for update in updates:
+                    self.dispatch(
+                        update.model_dump(mode="json", by_alias=True, exclude_none=True)
+                    )
+                    offset = update.update_id + 1
+        finally:
+            supervisor.cancel()
+
+    def stop(self, timeout: float = 10):
+        for updates_queue in self.queues.values():
+            updates_queue.put(None)
+        for process in self.processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+class ShardWorker(object):
+    """feeds updates from the supervisor queue into a local dispatcher
+
+    Every handled update is acknowledged, failed ones too. Updates the
+    worker took but did not acknowledge are handed over when it dies.
+    """
+
+    def __init__(self, shard: int, updates_queue, acks_queue):
+        self.shard = shard
+        self.updates_queue = updates_queue
+        self.acks_queue = acks_queue
+        # user id -> task handling the last received update of this user
+        self.tails = {}
+
+    async def process(self, bot, dp, update, previous):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            await dp.feed_raw_update(bot, update)
+        finally:
+            self.acks_queue.put(update["update_id"])
+
+    def schedule(self, bot, dp, update):
+        user_id = get_update_user_id(update)
+        previous = self.tails.get(user_id)
+        task = asyncio.create_task(self.process(bot, dp, update, previous))
+        self.tails[user_id] = task
+
+        def forget(done_task):
+            if self.tails.get(user_id) is done_task:
+                del self.tails[user_id]
+
+        task.add_done_callback(forget)
+
+    async def run(self, bot: Bot, dp: Dispatcher):
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await loop.run_in_executor(None, self.updates_queue.get)
+            if update is None:
+                break
+            self.schedule(bot, dp, update)
+
+        await asyncio.gather(*self.tails.values(), return_exceptions=True)
@@ -0,0 +1,216 @@
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+current_span: ContextVar["Span"] = ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str = None
+    start_ns: int = 0
+    end_ns: int = 0
+    sampled: bool = True
+    is_error: bool = False
+    attributes: dict = field(default_factory=dict)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1_000_000
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": self.duration_ms,
+            "error": self.is_error,
+            "attributes": self.attributes,
+        }
+
+
+class JsonLinesExporter(object):
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, "a", encoding="utf-8") as file:
+            for span in spans:
+                file.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+class OTLPHttpExporter(object):
+    """sends spans to an OTLP/HTTP collector using the JSON encoding"""
+
+    def __init__(self, endpoint, service_name="telenote", timeout=10):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    @staticmethod
+    def encode_value(value):
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def encode_span(self, span: Span):
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1 if span.parent_id else 2,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [
+                {"key": key, "value": self.encode_value(value)}
+                for key, value in span.attributes.items()
+            ],
+            "status": {"code": 2 if span.is_error else 1},
+        }
+        if span.parent_id:
+            encoded["parentSpanId"] = span.parent_id
+        return encoded
+
+    def export(self, spans):
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "telenote"},
+                            "spans": [self.encode_span(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            ...
+
+
+class Tracer(object):
+    MAX_BUFFERED_SPANS = 10_000
+
+    def __init__(self):
+        self.exporter = None
+        self.sample_ratio = 1.0
+        self.finished = []
+
+    def configure(self, exporter, sample_ratio: float = 1.0):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+
+    @property
+    def is_enabled(self):
+        return self.exporter is not None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        parent = current_span.get()
+        if parent is None:
+            trace_id = os.urandom(16).hex()
+            sampled = self.is_enabled and random.random() < self.sample_ratio
+        else:
+            trace_id = parent.trace_id
+            sampled = parent.sampled
+
+        span = Span(
+            name=name,
+            trace_id=trace_id,
+            span_id=os.urandom(8).hex(),
+            parent_id=parent.span_id if parent is not None else None,
+            start_ns=time.time_ns(),
+            sampled=sampled,
+            attributes=attributes,
+        )
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.is_error = True
+            span.set_attribute("exception", repr(error))
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            current_span.reset(token)
+            if span.sampled and len(self.finished) < self.MAX_BUFFERED_SPANS:
+                self.finished.append(span)
+
+    def traced(self, name):
+        """decorator wrapping a sync or async function call into a span"""
+
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    async def flush(self):
+        spans, self.finished = self.finished, []
+        if not spans or self.exporter is None:
+            return
+
+        try:
+            await asyncio.to_thread(self.exporter.export, spans)
+        except Exception:
+            logging.exception("Can not export %s spans", len(spans))
+
+    async def run_exporter(self, interval: float = 5):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+tracer = Tracer()
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from dataclasses import dataclass
+
+import whisper
+
+from bot.services.metrics import metrics
+
+transcription_queue_depth = metrics.gauge(
+    "transcription_queue_depth", "Voice messages waiting for transcription"
+)
+transcription_latency = metrics.histogram(
+    "transcription_latency_seconds", "Time from queueing a voice message to its text"
+)
+transcription_real_time_factor = metrics.gauge(
+    "transcription_real_time_factor", "Smoothed seconds of work per second of audio"
+)
+
+
+@dataclass
+class Transcription:
+    text: str
+    model: str
+
+
+class TranscriptionJob(object):
+    def __init__(self, path, duration):
+        self.path = path
+        # whisper works on 30 second windows, even a short clip costs something
+        self.duration = max(duration or 0, 1)
+        self.queued_at = time.monotonic()
+        self.result = asyncio.get_running_loop().create_future()
+
+
+class WhisperModel(object):
+    # rough seconds of work per second of audio on a CPU before any job ran
+    INITIAL_REAL_TIME_FACTORS = {
+        "tiny": 0.05,
+        "base": 0.1,
+        "small": 0.3,
+        "medium": 0.8,
+        "large": 1.6,
+    }
+
+    def __init__(self, size, smoothing: float = 0.3):
+        self.size = size
+        self.smoothing = smoothing
+        self.model = whisper.load_model(size)
+        self.real_time_factor = self.INITIAL_REAL_TIME_FACTORS.get(
+            size.split(".")[0].split("-")[0], 1.0
+        )
+        # decoding installs hooks on the model, so it runs one job at a time
+        self.lock = asyncio.Lock()
+
+    def observe(self, duration, elapsed):
+        self.real_time_factor += self.smoothing * (
+            elapsed / duration - self.real_time_factor
+        )
+        transcription_real_time_factor.set(self.real_time_factor, model=self.size)
+
+    def estimate(self, duration):
+        return duration * self.real_time_factor
+
+    async def transcribe(self, path, duration):
+        async with self.lock:
+            started_at = time.monotonic()
+            result = await asyncio.to_thread(self.model.transcribe, path)
+            self.observe(duration, time.monotonic() - started_at)
+        return result["text"]
+
+
+class Transcriber(object):
+    """transcribes voice messages with the largest model that is fast enough
+
+    Every job gets the largest preloaded model which is expected to finish
+    it, and the audio still waiting behind it, within ``latency_target``
+    seconds since the job was queued. Under load it steps down to smaller
+    models, and back up once the queue drains. Expected times come from a
+    moving average of the real time factor of every model. Only audio in
+    the queue and the rest of the jobs being transcribed is seen, so
+    callers should not queue voice messages up in front of it.
+    """
+
+    def __init__(
+        self, model_sizes: list[str], latency_target: float = 30, workers: int = 1
+    ):
+        # from the smallest to the largest
+        self.models = [WhisperModel(size) for size in model_sizes]
+        self.latency_target = latency_target
+        self.workers_count = workers
+        self.queue = asyncio.Queue()
+        self.queued_audio = 0
+        # job being transcribed -> (model, monotonic time it was started)
+        self.running = {}
+        self.workers = []
+
+    def get_running_work(self):
+        """expected seconds left of the jobs being transcribed"""
+
+        now = time.monotonic()
+        return sum(
+            max(model.estimate(job.duration) - (now - started_at), 0)
+            for job, (model, started_at) in self.running.items()
+        )
+
+    def choose_model(self, job: TranscriptionJob) -> WhisperModel:
+        waited = time.monotonic() - job.queued_at
+        backlog = self.queued_audio / self.workers_count
+        running_work = self.get_running_work() / self.workers_count
+        for model in reversed(self.models):
+            expected = waited + running_work + model.estimate(job.duration + backlog)
+            if expected <= self.latency_target:
+                return model
+        return self.models[0]
+
+    async def run_worker(self):
+        while True:
+            job = await self.queue.get()
+            self.queued_audio -= job.duration
+            transcription_queue_depth.set(self.queue.qsize())
+            if job.result.cancelled():
+                continue
+
+            model = self.choose_model(job)
+            self.running[job] = (model, time.monotonic())
+            try:
+                text = await model.transcribe(job.path, job.duration)
+            except Exception as error:
+                if not job.result.done():
+                    job.result.set_exception(error)
+                continue
+            finally:
+                del self.running[job]
+
+            transcription_latency.observe(
+                time.monotonic() - job.queued_at, model=model.size
+            )
+            if not job.result.done():
+                job.result.set_result(Transcription(text=text, model=model.size))
+
+    def start(self):
+        self.workers = [
+            asyncio.create_task(self.run_worker()) for _ in range(self.workers_count)
+        ]
+
+    async def transcribe(self, path, duration=None) -> Transcription:
+        job = TranscriptionJob(path, duration)
+        self.queued_audio += job.duration
+        self.queue.put_nowait(job)
+        transcription_queue_depth.set(self.queue.qsize())
+        return await job.result
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from bot.services.metrics import metrics
+from bot.services.processed_update_dal import ProcessedUpdateDAL
+
+skipped_updates = metrics.counter(
+    "update_ledger_skipped_total", "Redelivered updates skipped by the ledger"
+)
+ledger_lookups = metrics.counter(
+    "update_ledger_db_lookups_total", "Messages looked up in processed_updates"
+)
+ledger_pending = metrics.gauge(
+    "update_ledger_pending", "Processed updates waiting to be written"
+)
+
+
+class UpdateLedger(object):
+    """remembers handled messages, so redelivered updates are skipped
+
+    Recently handled keys live in a LRU cache in front of the
+    processed_updates table. New keys are written in batches, a key is
+    lost only when the process dies within ``flush_interval`` after the
+    message was handled.
+
+    The cache is filled from the table at start, after that it holds every
+    key processed since some time. A message sent after that time and
+    missing in the cache is new, the table is queried only for older ones.
+    """
+
+    # telegram and database clocks may disagree a bit
+    CLOCK_SKEW = timedelta(minutes=1)
+
+    def __init__(
+        self,
+        sessionmaker,
+        cache_size: int = 100_000,
+        flush_interval: float = 1.0,
+        flush_size: int = 500,
+        retention: timedelta = timedelta(hours=48),
+        prune_interval: float = 3600,
+    ):
+        self.sessionmaker = sessionmaker
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.retention = retention
+        self.prune_interval = prune_interval
+        # (chat id, message id) -> processed at, most recently seen last
+        self.cache = OrderedDict()
+        # every key processed after it is cached, None until warmed up
+        self.complete_since = None
+        self.evicted_until = datetime.min.replace(tzinfo=timezone.utc)
+        self.in_progress = set()
+        self.pending = []
+        self.flushed = asyncio.Event()
+
+    def remember(self, key, processed_at: datetime = None):
+        self.cache[key] = processed_at or datetime.now(timezone.utc)
+        self.cache.move_to_end(key)
+        self.evict()
+
+    def evict(self):
+        while len(self.cache) > self.cache_size:
+            _, processed_at = self.cache.popitem(last=False)
+            self.evicted_until = max(self.evicted_until, processed_at)
+
+    def is_surely_new(self, sent_at: datetime = None):
+        if sent_at is None or self.complete_since is None:
+            return False
+        complete_since = max(self.complete_since, self.evicted_until)
+        return sent_at - self.CLOCK_SKEW > complete_since
+
+    async def warm_up(self):
+        """caches keys processed within ``retention``, the latest first"""
+
+        processed_after = datetime.now(timezone.utc) - self.retention
+        async with self.sessionmaker() as session:
+            rows = await ProcessedUpdateDAL(session).get_processed_since(
+                processed_after, limit=self.cache_size
+            )
+
+        for chat_id, message_id, processed_at in rows:
+            key = (chat_id, message_id)
+            if key not in self.cache:
+                self.cache[key] = processed_at
+                # older than keys handled since the start
+                self.cache.move_to_end(key, last=False)
+        self.evict()
+
+        if len(rows) >= self.cache_size:
+            # older keys did not fit into the cache
+            processed_after = rows[-1].processed_at
+        self.complete_since = processed_after
+        logging.info("Update ledger warmed up with %s processed updates", len(rows))
+
+    async def start(self, key, sent_at: datetime = None) -> bool:
+        """False when the message is handled already or right now"""
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            skipped_updates.inc(source="memory")
+            return False
+        if key in self.in_progress:
+            skipped_updates.inc(source="in_progress")
+            return False
+
+        self.in_progress.add(key)
+        if self.is_surely_new(sent_at):
+            return True
+
+        ledger_lookups.inc()
+        try:
+            async with self.sessionmaker() as session:
+                processed = await ProcessedUpdateDAL(session).is_processed(*key)
+        except BaseException:
+            self.in_progress.discard(key)
+            raise
+
+        if processed:
+            self.in_progress.discard(key)
+            self.remember(key)
+            skipped_updates.inc(source="db")
+            return False
+        return True
+
+    def finish(self, key, succeeded: bool):
+        self.in_progress.discard(key)
+        if not succeeded:
+            return
+
+        self.remember(key)
+        self.pending.append(key)
+        ledger_pending.set(len(self.pending))
+        if len(self.pending) >= self.flush_size:
+            self.flushed.set()
+
+    async def flush(self):
+        keys, self.pending = self.pending, []
+        ledger_pending.set(0)
+        if not keys:
+            return
+
+        try:
+            async with self.sessionmaker() as session:
+                await ProcessedUpdateDAL(session).add_processed(keys)
+                await session.commit()
+        except Exception:
+            logging.exception("Can not write %s processed updates", len(keys))
+            self.pending = keys + self.pending
+            ledger_pending.set(len(self.pending))
+
+    async def prune(self):
+        processed_before = datetime.now(timezone.utc) - self.retention
+        async with self.sessionmaker() as session:
+            count = await ProcessedUpdateDAL(session).delete_older_than(
+                processed_before
+            )
+            await session.commit()
+        logging.info("Removed %s old processed updates", count)
+
+    async def run(self):
+        try:
+            await self.warm_up()
+        except Exception:
+            logging.exception("Can not warm up the update ledger")
+
+        pruned_at = time.monotonic()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.flushed.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.flushed.clear()
+                await self.flush()
+
+                if time.monotonic() - pruned_at >= self.prune_interval:
+                    pruned_at = time.monotonic()
+                    try:
+                        await self.prune()
+                    except Exception:
+                        logging.exception("Can not remove old processed updates")
+        finally:
+            await self.flush()
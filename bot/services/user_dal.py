@@ -1,6 +1,7 @@
 from sqlalchemy import select, update
 
 from bot.db.models import User
+from bot.services.tracing import tracer
 
 
 class BaseDAL(object):
@@ -9,6 +10,7 @@ class BaseDAL(object):
 
 
 class UserDAL(BaseDAL):
+    @tracer.traced("db.create_user")
     async def create_user(self, user_id: int, **kwargs) -> None:
         new_user = User(
             user_id=user_id,
@@ -17,6 +19,7 @@ class UserDAL(BaseDAL):
         self.session.add(new_user)
         await self.session.flush()
 
+    @tracer.traced("db.get_user_by_id")
     async def get_user_by_id(self, user_id: int) -> User:
         query = select(User).where(User.user_id == user_id)
         res = await self.session.execute(query)
@@ -24,6 +27,7 @@ class UserDAL(BaseDAL):
         if user_row is not None:
             return user_row[0]
 
+    @tracer.traced("db.update_user")
     async def update_user(self, user_id: int, **kwargs) -> None:
         query = (
             update(User)
@@ -31,4 +35,4 @@ class UserDAL(BaseDAL):
             .values(kwargs)
             .returning(User.user_id)
         )
-        await self.db_session.execute(query)
+        await self.session.execute(query)
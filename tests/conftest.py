@@ -0,0 +1,93 @@
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+
+
+def git(*args, cwd=None, env=None):
+    process = subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        env={**os.environ, **env} if env else None,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return process.stdout.strip()
+
+
+class RemoteRepository(object):
+    """bare repository standing in for github, changed through a clone"""
+
+    def __init__(self, root: Path, branch="main"):
+        self.path = root / "remote.git"
+        self.work = root / "work"
+        self.branch = branch
+        git("init", "--quiet", "--bare", "--initial-branch", branch, str(self.path))
+        git("clone", "--quiet", str(self.path), str(self.work))
+        git("config", "user.name", "Human", cwd=self.work)
+        git("config", "user.email", "human@example.com", cwd=self.work)
+
+    @property
+    def url(self):
+        return str(self.path)
+
+    def commit(self, message, files: dict = None, date: str = None):
+        """commits files on top of the remote branch, returns the sha"""
+
+        if self.tip is not None:
+            git("fetch", "--quiet", "origin", self.branch, cwd=self.work)
+            git("checkout", "--quiet", "-B", self.branch, "FETCH_HEAD", cwd=self.work)
+        for file_path, content in (files or {}).items():
+            file = self.work / file_path
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(content)
+            git("add", file_path, cwd=self.work)
+
+        env = {"GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date} if date else None
+        git("commit", "--quiet", "--allow-empty", "-m", message, cwd=self.work, env=env)
+        git("push", "--quiet", "origin", f"HEAD:{self.branch}", cwd=self.work)
+        return self.tip
+
+    def rewrite(self, message):
+        """replaces the whole history with a single commit of the same tree"""
+
+        tree = git("rev-parse", f"{self.branch}^{{tree}}", cwd=self.path)
+        sha = git("commit-tree", tree, "-m", message, cwd=self.work)
+        git(
+            "push",
+            "--quiet",
+            "--force",
+            "origin",
+            f"{sha}:{self.branch}",
+            cwd=self.work,
+        )
+        return sha
+
+    @property
+    def tip(self):
+        try:
+            return git("rev-parse", "--verify", "--quiet", self.branch, cwd=self.path)
+        except subprocess.CalledProcessError:
+            return None
+
+    def messages(self):
+        """commit messages of the branch, the latest first"""
+
+        return git("log", "--format=%s", self.branch, cwd=self.path).splitlines()
+
+    def show(self, file_path):
+        return git("show", f"{self.branch}:{file_path}", cwd=self.path)
+
+    def is_ancestor(self, sha):
+        try:
+            git("merge-base", "--is-ancestor", sha, self.branch, cwd=self.path)
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+
+@pytest.fixture
+def remote(tmp_path):
+    return RemoteRepository(tmp_path)
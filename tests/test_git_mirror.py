@@ -0,0 +1,227 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from bot.services.git_mirror import GitMirrorCache, MirrorNoteStorage
+from bot.services.media_stream import MediaStream
+from bot.services.repository_lock import RepositoryLockTimeout
+
+
+def note_user(remote):
+    return SimpleNamespace(
+        repository="user/notes", remote_url=remote.url, branch=remote.branch
+    )
+
+
+class FakeLocker(object):
+    def __init__(self, busy=False):
+        self.busy = busy
+        self.locked = []
+
+    @asynccontextmanager
+    async def lock(self, repository, branch):
+        if self.busy:
+            raise RepositoryLockTimeout(f"{repository}@{branch} is busy")
+        self.locked.append((repository, branch))
+        yield
+
+
+def create_storage(tmp_path, push_batch_size=2, locker=None):
+    cache = GitMirrorCache(
+        root=tmp_path / "mirrors",
+        push_batch_size=push_batch_size,
+        push_interval=3600,
+        locker=locker,
+    )
+    return MirrorNoteStorage(cache)
+
+
+async def get_mirror(storage, remote):
+    return await storage.cache.get("user/notes", remote.url, remote.branch)
+
+
+@pytest.fixture
+def notes_remote(remote):
+    remote.commit("Initial commit", {"notes.md": "# Notes"})
+    return remote
+
+
+def test_commits_into_the_clone_and_pushes_in_batches(tmp_path, notes_remote):
+    storage = create_storage(tmp_path, push_batch_size=2)
+    user = note_user(notes_remote)
+
+    async def run():
+        first = await storage.commit(user, appends={"notes.md": "first"})
+        assert notes_remote.messages() == ["Initial commit"]
+
+        second = await storage.commit(
+            user, files={"assets/photo.jpg": b"jpeg"}, message="Upload photo"
+        )
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert notes_remote.tip == second
+    assert notes_remote.is_ancestor(first)
+    assert notes_remote.messages() == ["Upload photo", "Append data", "Initial commit"]
+    assert notes_remote.show("notes.md") == "# Notes\nfirst"
+    assert notes_remote.show("assets/photo.jpg") == "jpeg"
+
+
+def test_close_pushes_pending_commits(tmp_path, notes_remote):
+    storage = create_storage(tmp_path, push_batch_size=10)
+
+    async def run():
+        sha = await storage.commit(note_user(notes_remote), appends={"notes.md": "a"})
+        await storage.close()
+        return sha
+
+    sha = asyncio.run(run())
+
+    assert notes_remote.tip == sha
+
+
+def test_rebases_local_commits_when_the_remote_moved(tmp_path, notes_remote):
+    storage = create_storage(tmp_path, push_batch_size=10)
+
+    async def run():
+        await storage.commit(note_user(notes_remote), appends={"notes.md": "bot"})
+        notes_remote.commit("Add todo", {"todo.md": "- todo"})
+        await (await get_mirror(storage, notes_remote)).push()
+
+    asyncio.run(run())
+
+    assert notes_remote.messages() == ["Append data", "Add todo", "Initial commit"]
+    assert notes_remote.show("notes.md") == "# Notes\nbot"
+    assert notes_remote.show("todo.md") == "- todo"
+
+
+def test_replays_only_local_commits_on_a_rewritten_remote(tmp_path, notes_remote):
+    notes_remote.commit("Append data", {"notes.md": "# Notes\nold"})
+    storage = create_storage(tmp_path, push_batch_size=10)
+
+    async def run():
+        await storage.commit(note_user(notes_remote), appends={"notes.md": "new"})
+        # the history is compacted while the mirror holds an unpushed commit
+        notes_remote.rewrite("Compact 2 commits of 2026-10-01")
+        await (await get_mirror(storage, notes_remote)).push()
+
+    asyncio.run(run())
+
+    assert notes_remote.messages() == [
+        "Append data",
+        "Compact 2 commits of 2026-10-01",
+    ]
+    assert notes_remote.show("notes.md") == "# Notes\nold\nnew"
+
+
+def test_refuses_files_outside_of_the_working_tree(tmp_path, notes_remote):
+    storage = create_storage(tmp_path)
+
+    async def run():
+        with pytest.raises(ValueError):
+            await storage.commit(
+                note_user(notes_remote),
+                appends={"notes.md": "lost", "../escape.md": "x"},
+            )
+        await storage.commit(note_user(notes_remote), appends={"notes.md": "kept"})
+        await storage.close()
+
+    asyncio.run(run())
+
+    assert not (tmp_path / "mirrors" / "escape.md").exists()
+    assert notes_remote.messages() == ["Append data", "Initial commit"]
+    assert notes_remote.show("notes.md") == "# Notes\nkept"
+
+
+def test_returns_the_sha_the_note_got_on_the_remote(tmp_path, notes_remote):
+    storage = create_storage(tmp_path, push_batch_size=2)
+    user = note_user(notes_remote)
+
+    async def run():
+        await storage.commit(user, appends={"notes.md": "first"})
+        notes_remote.commit("Add todo", {"todo.md": "- todo"})
+        return await storage.commit(user, appends={"notes.md": "second"})
+
+    sha = asyncio.run(run())
+
+    assert notes_remote.tip == sha
+    assert notes_remote.messages() == [
+        "Append data",
+        "Append data",
+        "Add todo",
+        "Initial commit",
+    ]
+
+
+def test_waits_for_an_evicted_mirror_to_be_removed(tmp_path, notes_remote):
+    storage = create_storage(tmp_path, push_batch_size=10)
+    user = note_user(notes_remote)
+
+    async def run():
+        await storage.commit(user, appends={"notes.md": "first"})
+        key = storage.cache.get_key(user.repository, user.branch)
+        evicting = asyncio.create_task(storage.cache.evict(key))
+        await asyncio.sleep(0)
+
+        await storage.commit(user, appends={"notes.md": "second"})
+        await evicting
+        await storage.close()
+
+    asyncio.run(run())
+
+    assert notes_remote.show("notes.md") == "# Notes\nfirst\nsecond"
+
+
+def test_pushes_under_the_repository_lock(tmp_path, notes_remote):
+    locker = FakeLocker()
+    storage = create_storage(tmp_path, push_batch_size=1, locker=locker)
+
+    sha = asyncio.run(
+        storage.commit(note_user(notes_remote), appends={"notes.md": "a"})
+    )
+
+    assert notes_remote.tip == sha
+    assert locker.locked == [("user/notes", notes_remote.branch)]
+
+
+def test_keeps_commits_local_while_the_repository_is_locked(tmp_path, notes_remote):
+    locker = FakeLocker(busy=True)
+    storage = create_storage(tmp_path, push_batch_size=1, locker=locker)
+
+    async def run():
+        await storage.commit(note_user(notes_remote), appends={"notes.md": "a"})
+        assert notes_remote.messages() == ["Initial commit"]
+
+        locker.busy = False
+        await storage.close()
+
+    asyncio.run(run())
+
+    assert notes_remote.messages() == ["Append data", "Initial commit"]
+
+
+def test_drops_a_note_whose_download_failed(tmp_path, notes_remote):
+    storage = create_storage(tmp_path, push_batch_size=10)
+    user = note_user(notes_remote)
+
+    async def broken_download():
+        yield b"partial"
+        raise ConnectionError("download failed")
+
+    async def run():
+        with pytest.raises(ConnectionError):
+            await storage.commit(
+                user,
+                appends={"notes.md": "![](assets/photo.jpg)"},
+                files={"assets/photo.jpg": MediaStream(broken_download())},
+            )
+        await storage.commit(user, appends={"notes.md": "kept"})
+        await storage.close()
+
+    asyncio.run(run())
+
+    assert notes_remote.show("notes.md") == "# Notes\nkept"
+    assert not (tmp_path / "mirrors" / "user__notes@main" / "assets").exists()
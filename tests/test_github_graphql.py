@@ -0,0 +1,152 @@
+import asyncio
+import json
+from base64 import b64decode
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+
+from bot.services.github_graphql import (
+    GithubGraphQL,
+    GraphQLError,
+    GraphQLNoteStorage,
+)
+from bot.services.media_stream import MediaStream
+
+
+class FakeGithub(object):
+    """one branch of one repository behind a minimal graphql endpoint"""
+
+    def __init__(self, files: dict):
+        self.files = dict(files)
+        self.commits = 0
+        self.mutations = 0
+        # commits pushed by someone else right after the next head queries
+        self.concurrent_commits = []
+
+    @property
+    def head(self):
+        return f"{self.commits:040x}"
+
+    def push(self, files: dict):
+        self.files.update(files)
+        self.commits += 1
+
+    def query_head(self, variables):
+        repository = {"ref": {"target": {"oid": self.head}}}
+        for name, expression in variables.items():
+            if name.startswith("expression"):
+                file_path = expression.split(":", 1)[1]
+                text = self.files.get(file_path)
+                repository[name.replace("expression", "file")] = (
+                    None if text is None else {"text": text, "isTruncated": False}
+                )
+        if self.concurrent_commits:
+            self.push(self.concurrent_commits.pop(0))
+        return {"data": {"repository": repository}}
+
+    def create_commit(self, commit_input):
+        self.mutations += 1
+        if commit_input["expectedHeadOid"] != self.head:
+            return {
+                "errors": [
+                    {
+                        "type": "STALE_DATA",
+                        "message": "Expected branch to point to "
+                        f"{commit_input['expectedHeadOid']} but it did not.",
+                    }
+                ]
+            }
+
+        self.push(
+            {
+                addition["path"]: b64decode(addition["contents"]).decode("utf-8")
+                for addition in commit_input["fileChanges"]["additions"]
+            }
+        )
+        return {"data": {"createCommitOnBranch": {"commit": {"oid": self.head}}}}
+
+    async def handle(self, request):
+        payload = json.loads(await request.read())
+        if payload["query"].lstrip().startswith("mutation"):
+            return web.json_response(self.create_commit(payload["variables"]["input"]))
+        return web.json_response(self.query_head(payload["variables"]))
+
+
+@asynccontextmanager
+async def graphql_storage(github: FakeGithub):
+    app = web.Application()
+    app.router.add_post("/graphql", github.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+
+    storage = GraphQLNoteStorage(GithubGraphQL(f"http://{host}:{port}/graphql"))
+    try:
+        yield storage
+    finally:
+        await storage.close()
+        await runner.cleanup()
+
+
+NOTE_USER = SimpleNamespace(
+    github_token="token", repository="user/notes", branch="main"
+)
+
+
+def commit(github, **kwargs):
+    async def run():
+        async with graphql_storage(github) as storage:
+            return await storage.commit(NOTE_USER, **kwargs)
+
+    return asyncio.run(run())
+
+
+def test_appends_notes_and_adds_files():
+    github = FakeGithub({"notes.md": "# Notes"})
+
+    async def chunks():
+        yield b"streamed "
+        yield b"photo"
+
+    oid = commit(
+        github,
+        appends={"notes.md": "note", "/todo.md": "- todo"},
+        files={"/a.txt": b"bytes", "b.jpg": MediaStream(chunks())},
+    )
+
+    assert oid == github.head
+    assert github.files == {
+        "notes.md": "# Notes\nnote",
+        "todo.md": "\n- todo",
+        "a.txt": "bytes",
+        "b.jpg": "streamed photo",
+    }
+
+
+def test_retries_when_the_branch_moved_after_the_head_query():
+    github = FakeGithub({"notes.md": "# Notes"})
+    github.concurrent_commits = [{"notes.md": "# Notes\nconcurrent"}]
+
+    commit(github, appends={"notes.md": "mine"})
+
+    assert github.mutations == 2
+    assert github.files["notes.md"] == "# Notes\nconcurrent\nmine"
+
+
+def test_gives_up_when_the_branch_keeps_moving():
+    github = FakeGithub({"notes.md": "# Notes"})
+    github.concurrent_commits = [
+        {"notes.md": f"# Notes\nconcurrent {index}"}
+        for index in range(GraphQLNoteStorage.MAX_ATTEMPTS)
+    ]
+
+    with pytest.raises(GraphQLError) as error:
+        commit(github, appends={"notes.md": "mine"})
+
+    assert error.value.is_stale_head
+    assert github.mutations == GraphQLNoteStorage.MAX_ATTEMPTS
+    assert "mine" not in github.files["notes.md"]
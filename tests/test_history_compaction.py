@@ -0,0 +1,99 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from bot.services.git_mirror import GitError
+from bot.services.history_compaction import HistoryCompaction
+
+OLDER_THAN = datetime(2026, 10, 10, tzinfo=timezone.utc)
+
+
+def note_user(remote):
+    return SimpleNamespace(
+        branch=remote.branch, remote_url=remote.url, repository="user/notes"
+    )
+
+
+def compact(tmp_path, remote, locker=None):
+    compaction = HistoryCompaction(
+        tmp_path / "compaction.git", note_user(remote), locker
+    )
+    return asyncio.run(compaction(OLDER_THAN))
+
+
+def add_notes(remote, day, count, hour=10):
+    for index in range(count):
+        remote.commit(
+            "Append data",
+            {"notes.md": f"{remote.show('notes.md')}\nnote {day} {index}"},
+            date=f"2026-10-{day:02}T{hour}:{index:02}:00+00:00",
+        )
+
+
+class MovingLocker(object):
+    """a note is committed right before the compacted history is pushed"""
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.note_sha = None
+
+    @asynccontextmanager
+    async def lock(self, repository, branch):
+        self.note_sha = self.remote.commit("Append data", {"late.md": "late note"})
+        yield
+
+
+@pytest.fixture
+def history(remote):
+    remote.commit(
+        "Initial commit", {"notes.md": "# Notes"}, date="2026-09-01T10:00:00+00:00"
+    )
+    add_notes(remote, day=1, count=2)
+    human_sha = remote.commit(
+        "Reorganize notes", {"todo.md": "- todo"}, date="2026-10-02T10:00:00+00:00"
+    )
+    add_notes(remote, day=3, count=3)
+    add_notes(remote, day=4, count=2)
+    add_notes(remote, day=18, count=1)
+    return SimpleNamespace(human_sha=human_sha, notes=remote.show("notes.md"))
+
+
+def test_squashes_bot_commits_after_the_last_human_commit(tmp_path, remote, history):
+    result = compact(tmp_path, remote)
+
+    assert result.commits_before == 6
+    assert result.commits_after == 3
+    assert result.bytes_saved > 0
+    assert remote.messages() == [
+        "Append data",
+        "Compact 2 commits of 2026-10-04",
+        "Compact 3 commits of 2026-10-03",
+        "Reorganize notes",
+        "Append data",
+        "Append data",
+        "Initial commit",
+    ]
+    assert remote.is_ancestor(history.human_sha)
+    assert remote.show("notes.md") == history.notes
+
+
+def test_keeps_history_which_ends_with_a_human_commit(tmp_path, remote, history):
+    tip = remote.commit("Fix typo", {"todo.md": "- todo!"})
+
+    result = compact(tmp_path, remote)
+
+    assert result.commits_saved == 0
+    assert remote.tip == tip
+
+
+def test_does_not_overwrite_a_branch_which_moved(tmp_path, remote, history):
+    locker = MovingLocker(remote)
+
+    with pytest.raises(GitError):
+        compact(tmp_path, remote, locker)
+
+    assert remote.tip == locker.note_sha
+    assert remote.messages().count("Append data") == 9
@@ -0,0 +1,104 @@
+import queue
+
+from bot.services.sharding import ShardSupervisor, get_shard
+
+
+class FakeProcess(object):
+    alive = True
+    exitcode = None
+
+    def is_alive(self):
+        return self.alive
+
+
+class FakeSupervisor(ShardSupervisor):
+    """supervisor whose workers are in-process queues"""
+
+    def start_worker(self, shard):
+        self.queues[shard] = queue.Queue()
+        self.acks[shard] = queue.Queue()
+        self.processes[shard] = FakeProcess()
+
+    def take(self, shard):
+        updates = []
+        while not self.queues[shard].empty():
+            updates.append(self.queues[shard].get_nowait())
+        return updates
+
+    def kill(self, shard):
+        self.processes[shard].alive = False
+        self.processes[shard].exitcode = -9
+
+
+def message(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "from": {"id": user_id}},
+    }
+
+
+def update_ids(updates):
+    return [update["update_id"] for update in updates]
+
+
+def create_supervisor(workers_count=2):
+    supervisor = FakeSupervisor(workers_count, None, restart_delay=3600)
+    supervisor.start()
+    return supervisor
+
+
+def find_user(shard, shards=(0, 1)):
+    return next(
+        user_id for user_id in range(1000) if get_shard(user_id, shards) == shard
+    )
+
+
+def test_keeps_users_on_their_worker_until_it_acknowledges():
+    supervisor = create_supervisor()
+    user_id = find_user(0)
+
+    supervisor.dispatch(message(1, user_id))
+    # the worker died unnoticed, then another update of the user comes in
+    supervisor.kill(0)
+    supervisor.dispatch(message(2, user_id))
+    assert update_ids(supervisor.take(0)) == [1, 2]
+
+    supervisor.check_workers()
+
+    assert update_ids(supervisor.take(1)) == [1, 2]
+    assert update_ids(supervisor.take(0)) == []
+
+
+def test_moves_users_back_after_their_updates_are_acknowledged():
+    supervisor = create_supervisor()
+    user_id = find_user(0)
+    supervisor.kill(0)
+    supervisor.restarts[0] = (float("inf"), 1)
+    supervisor.check_workers()
+
+    supervisor.dispatch(message(1, user_id))
+    assert update_ids(supervisor.take(1)) == [1]
+
+    # the restarted worker does not get the user before its update is done
+    supervisor.start_worker(0)
+    supervisor.dispatch(message(2, user_id))
+    assert update_ids(supervisor.take(1)) == [2]
+
+    supervisor.acks[1].put(1)
+    supervisor.acks[1].put(2)
+    supervisor.receive_acks()
+    supervisor.dispatch(message(3, user_id))
+    assert update_ids(supervisor.take(0)) == [3]
+
+
+def test_hands_over_updates_put_while_every_worker_was_dead():
+    supervisor = create_supervisor(workers_count=1)
+    supervisor.kill(0)
+    supervisor.restarts[0] = (float("inf"), 1)
+    supervisor.check_workers()
+
+    supervisor.dispatch(message(1, 42))
+    supervisor.restarts[0] = (0, 1)
+    supervisor.check_workers()
+
+    assert update_ids(supervisor.take(0)) == [1]